@@ -0,0 +1,163 @@
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+'''
+helpers for doing document work away from the gui thread.
+
+none of this depends on wx: results are handed back through a post
+function, which for a wx app should be wx.CallAfter so they arrive on
+the gui thread.
+'''
+
+def call_now(fn, *args):
+    fn(*args)
+
+class SearchScheduler(object):
+    '''
+    runs searches for a document on a worker thread, once typing in the
+    search box has paused for delay seconds.  starting a new search
+    cancels any that are still waiting or running, and only the results
+    of the latest search are passed to the callback.
+    '''
+
+    def __init__(self, doc, callback, delay=0.2, post=call_now):
+        self.doc=doc
+        self.callback=callback
+        self.delay=delay
+        self.post=post
+        self._generation=0
+        self._timer=None
+
+    def schedule(self, q):
+        '''search for q in the background (called from the gui thread)'''
+        self.cancel()
+        if not q:
+            # clearing the search shows everything, which needs no searching,
+            # so it's done straight away rather than after the delay
+            self.callback(self.doc.search_job(q))
+            return
+        generation=self._generation
+        # set up the search now, while we're on the same thread as the
+        # document, so it runs against a snapshot of the text as it is now
+        job=self.doc.search_job(q, snapshot=True)
+        self._timer=threading.Timer(self.delay, self._run, (job, generation))
+        self._timer.daemon=True
+        self._timer.start()
+
+    def cancel(self):
+        '''stop any search that hasn't delivered its results yet'''
+        self._generation += 1
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer=None
+
+    def _is_cancelled(self, generation):
+        return generation != self._generation
+
+    def _run(self, job, generation):
+        cancelled=lambda: self._is_cancelled(generation)
+        if job.run(cancelled) and not cancelled():
+            self.post(self._deliver, job, generation)
+
+    def _deliver(self, job, generation):
+        if not self._is_cancelled(generation):
+            self._timer=None
+            self.callback(job)
+
+class SaveScheduler(object):
+    '''
+    auto-saves documents every interval seconds on a worker thread.
+    there's one for the whole app, and the saves for different documents
+    are spread out over the interval rather than all happening at once.
+    documents that haven't changed are skipped.  poll() should be called
+    every so often from the gui thread, to start any saves that are due.
+    '''
+
+    def __init__(self, interval=5*60, post=call_now, clock=time.time):
+        self.interval=interval
+        self.post=post
+        self.clock=clock
+        # (doc, callback, enabled) in the order they take turns
+        self._docs=[]
+        self._turn=0
+        self._next_save=None
+        self._saving=set()
+        self._queue=queue.Queue()
+        self._worker=None
+
+    def add(self, doc, callback=None, enabled=None):
+        '''
+        start auto-saving a document.  callback(doc, error) is called on the
+        gui thread after each save, and enabled() can turn auto-saving off
+        '''
+        self._docs.append((doc, callback, enabled))
+        next_save=self.clock()+self._spacing()
+        if self._next_save is None or next_save < self._next_save:
+            self._next_save=next_save
+
+    def remove(self, doc):
+        self._docs=[entry for entry in self._docs if entry[0] is not doc]
+
+    def _spacing(self):
+        return float(self.interval)/max(len(self._docs), 1)
+
+    def poll(self):
+        '''start the next auto-save, if it's due (called from the gui thread)'''
+        # in between saves, start writing the latest edits to the journals
+        # (which happens on their own threads, so this doesn't wait)
+        for doc, callback, enabled in self._docs:
+            doc.flush_journal()
+        now=self.clock()
+        if self._next_save is None or now < self._next_save:
+            return
+        self._next_save=now+self._spacing()
+        # the next document in turn that needs saving
+        for i in range(len(self._docs)):
+            self._turn=(self._turn+1) % len(self._docs)
+            doc, callback, enabled=self._docs[self._turn]
+            if enabled is not None and not enabled():
+                continue
+            if doc.filename and doc.is_modified and doc not in self._saving:
+                self.save(doc, callback)
+                break
+
+    def save(self, doc, callback=None):
+        '''save a document now, on the worker thread'''
+        self._saving.add(doc)
+        self._queue.put((doc, doc.save_job(), callback))
+        if self._worker is None:
+            self._worker=threading.Thread(target=self._work)
+            self._worker.daemon=True
+            self._worker.start()
+
+    def flush(self):
+        '''wait for any saves that have been started to finish'''
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            doc, job, callback=self._queue.get()
+            try:
+                try:
+                    job.run()
+                    error=None
+                except Exception:
+                    # report anything that goes wrong, rather than losing
+                    # the worker and with it every auto-save after this
+                    error=sys.exc_info()[1]
+                self.post(self._finished, doc, job, callback, error)
+            finally:
+                self._queue.task_done()
+
+    def _finished(self, doc, job, callback, error):
+        try:
+            doc.saved(job)
+        finally:
+            self._saving.discard(doc)
+        if callback is not None:
+            callback(doc, error)
@@ -0,0 +1,396 @@
+import gc
+import json
+import optparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from model import Document, UndoableDocument
+from pipe import SocketPipe
+
+'''
+timings of the document model on generated notes, to check how it scales
+and to catch anything getting slower.  it doesn't need wx.
+
+    python bench.py [-o results.json] [-b baseline.json] [--max-size 1M] [-k search]
+
+documents go from 1KB up to 100MB, and searches from 1 up to 100000
+visible sections.  each timing is the best of a few runs.  results can be
+saved as json and compared with results saved earlier: anything that's
+got slower by more than the threshold is listed, and the exit status is
+1 if there was anything.
+'''
+
+SIZES=[1024, 64*1024, 1024*1024, 16*1024*1024, 100*1024*1024]
+SECTIONS=[1, 100, 10000, 100000]
+# the biggest document used for the timings that vary the number of sections
+SECTIONS_SIZE=16*1024*1024
+# how many edits to time, for insert, remove, undo and redo
+EDITS=1000
+# differences smaller than this are just noise
+MIN_DIFFERENCE=0.001
+
+LINE='note %07d about topic%02d and other things%s\n'
+LINE_LENGTH=len(LINE % (0, 0, ''))
+MARKER=' marker'
+
+def parse_size(size):
+    '''a size such as 64K or 16M in bytes'''
+    units={'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    size=size.strip().upper()
+    if size[-1:] in units:
+        return int(float(size[:-1])*units[size[-1]])
+    return int(size)
+
+def format_size(size):
+    for unit, scale in (('G', 1024**3), ('M', 1024**2), ('K', 1024)):
+        if size >= scale and size % scale == 0:
+            return '%d%s' % (size//scale, unit)
+    return str(size)
+
+def generate(size, sections=1):
+    '''
+    about size characters of notes, with the word "marker" on sections
+    of the lines, spread out evenly
+    '''
+    lines=max(size//LINE_LENGTH, 1)
+    step=max(lines//max(sections, 1), 1)
+    return ''.join(LINE % (i, i % 97, MARKER if i % step == 0 and i//step < sections else '')
+                   for i in range(lines))
+
+def best_of(repeat, fn, setup):
+    '''the shortest time fn(setup()) takes, out of repeat runs'''
+    best=None
+    for i in range(repeat):
+        arg=setup()
+        # the same as timeit, so a collection doesn't land in one of the runs
+        gc.disable()
+        try:
+            started=time.time()
+            fn(arg)
+            elapsed=time.time()-started
+        finally:
+            gc.enable()
+        if best is None or elapsed < best:
+            best=elapsed
+    return best
+
+class Bench(object):
+    '''runs the timings, keeping the generated files around between them'''
+
+    def __init__(self, sizes=SIZES, sections=SECTIONS, repeat=3, match=None, out=sys.stdout):
+        self.sizes=sizes
+        self.sections=sections
+        self.repeat=repeat
+        self.match=match
+        self.out=out
+        self.results=[]
+        self.dirname=tempfile.mkdtemp()
+        self._files={}
+
+    def close(self):
+        shutil.rmtree(self.dirname)
+
+    def filename(self, size, sections=1):
+        '''the name of a file of generated notes'''
+        key=(size, sections)
+        if key not in self._files:
+            filename=os.path.join(self.dirname, 'notes-%s-%d.obs' % (format_size(size), sections))
+            file=open(filename, 'w')
+            try:
+                file.write(generate(size, sections))
+            finally:
+                file.close()
+            self._files[key]=filename
+        return self._files[key]
+
+    def new(self, doc_class):
+        '''
+        a document that doesn't keep a journal of its edits, so the timings
+        are of the model rather than the disk (and no writer threads are
+        left running)
+        '''
+        doc=doc_class()
+        doc.JOURNAL=False
+        return doc
+
+    def open(self, doc_class, size, sections=1):
+        doc=self.new(doc_class)
+        doc.open(self.filename(size, sections))
+        return doc
+
+    def wanted(self, name):
+        return self.match is None or self.match in name
+
+    def record(self, name, doc_class, size, sections, seconds, ops=1):
+        result={
+            'name': name,
+            'doc': doc_class.__name__ if doc_class is not None else None,
+            'size': size,
+            'sections': sections,
+            'seconds': seconds,
+            'ops': ops,
+        }
+        self.results.append(result)
+        self.out.write('%s\n' % format_result(result))
+        self.out.flush()
+
+    def run(self):
+        for size in self.sizes:
+            for doc_class in (Document, UndoableDocument):
+                self.run_size(doc_class, size)
+        size=min(SECTIONS_SIZE, max(self.sizes))
+        for sections in self.sections:
+            if sections > size//LINE_LENGTH:
+                continue
+            for doc_class in (Document, UndoableDocument):
+                self.run_sections(doc_class, size, sections)
+        if self.wanted('startup'):
+            self.run_startup()
+        return self.results
+
+    def run_size(self, doc_class, size):
+        '''the timings that depend on the size of the document'''
+        if self.wanted('open'):
+            filename=self.filename(size)
+            self.record('open', doc_class, size, None,
+                        best_of(self.repeat, lambda doc: doc.open(filename), lambda: self.new(doc_class)))
+        doc=None
+        searches=[
+            ('search_one_word', 'marker'),
+            ('search_several_words', 'marker note things'),
+            ('search_many_hits', 'note'),
+            ('search_no_hits', 'zyzzyva'),
+        ]
+        for name, q in searches:
+            if self.wanted(name):
+                doc=doc or self.open(doc_class, size, 100)
+                self.record(name, doc_class, size, None,
+                            best_of(self.repeat, lambda doc: doc.search(q),
+                                    lambda: self._cleared(doc)))
+        if self.wanted('insert') or self.wanted('remove'):
+            doc=self._cleared(doc or self.open(doc_class, size, 100))
+            edits=self._edits(doc)
+            if self.wanted('insert'):
+                self.record('insert', doc_class, size, None,
+                            best_of(self.repeat, lambda doc: self._insert(doc, edits), lambda: doc),
+                            len(edits))
+            if self.wanted('remove'):
+                self.record('remove', doc_class, size, None,
+                            best_of(self.repeat, lambda doc: self._remove(doc, edits), lambda: doc),
+                            len(edits))
+        if doc_class is UndoableDocument and (self.wanted('undo') or self.wanted('redo')):
+            doc=self.open(doc_class, size, 100)
+            self._insert(doc, self._edits(doc))
+            # older edits may have been dropped to keep the undo size down
+            steps=self._undo_all(doc)
+            self._redo_all(doc)
+            if self.wanted('undo'):
+                self.record('undo', doc_class, size, None,
+                            best_of(self.repeat, self._undo_all, lambda: self._redone(doc)),
+                            steps)
+            if self.wanted('redo'):
+                self.record('redo', doc_class, size, None,
+                            best_of(self.repeat, self._redo_all, lambda: self._undone(doc)),
+                            steps)
+
+    def run_sections(self, doc_class, size, sections):
+        '''the timings that depend on how many sections are visible'''
+        if self.wanted('search_sections') or self.wanted('visible_text'):
+            doc=self.open(doc_class, size, sections)
+            if self.wanted('search_sections'):
+                self.record('search_sections', doc_class, size, sections,
+                            best_of(self.repeat, lambda doc: doc.search('marker'),
+                                    lambda: self._cleared(doc)))
+            if self.wanted('visible_text'):
+                doc.search('marker')
+                self.record('visible_text', doc_class, size, sections,
+                            best_of(self.repeat, lambda doc: doc.visible_text, lambda: doc))
+        if self.wanted('remove_across_sections'):
+            self.record('remove_across_sections', doc_class, None, sections,
+                        best_of(self.repeat, lambda doc: self._remove_across_sections(doc, sections),
+                                lambda: self._across_sections(doc_class, sections)))
+
+    def run_startup(self):
+        '''how long it takes to start the app, or pass a file to one that's running'''
+        self.record('startup_interpreter', None, None, None, run_python('pass'))
+        self.record('startup_handoff', None, None, None, handoff(self.filename(min(self.sizes))))
+        elapsed=cold_start()
+        if elapsed is None:
+            self.out.write('startup_cold: skipped (wx not available)\n')
+        else:
+            self.record('startup_cold', None, None, None, elapsed)
+
+    def _cleared(self, doc):
+        doc.search('')
+        return doc
+
+    def _edits(self, doc):
+        '''offsets to edit at, spread through the document'''
+        length=len(doc.view)
+        rand=random.Random(length)
+        return [rand.randrange(length) for i in range(EDITS)]
+
+    def _insert(self, doc, edits):
+        for offset in edits:
+            doc.insert(offset, 'x')
+
+    def _remove(self, doc, edits):
+        for offset in edits:
+            doc.remove(offset, 1)
+
+    def _undo_all(self, doc):
+        steps=0
+        while doc.can_undo():
+            doc.undo()
+            steps += 1
+        return steps
+
+    def _redo_all(self, doc):
+        steps=0
+        while doc.can_redo():
+            doc.redo()
+            steps += 1
+        return steps
+
+    def _redone(self, doc):
+        self._redo_all(doc)
+        return doc
+
+    def _undone(self, doc):
+        self._undo_all(doc)
+        return doc
+
+    def _across_sections(self, doc_class, n):
+        doc=self.new(doc_class)
+        doc.insert(0, ''.join('hello %d\nother %d\n' % (i, i) for i in range(n+1)))
+        doc.search('hello')
+        return doc
+
+    def _remove_across_sections(self, doc, n):
+        # from part way through the first hit to part way through the last
+        start=3
+        end=doc.visible_sections.visible_offset(n)+3
+        doc.remove(start, end-start)
+
+def run_python(code, *args):
+    '''time running some code in a new python process, or None if it fails'''
+    started=time.time()
+    devnull=open(os.devnull, 'w')
+    try:
+        result=subprocess.call([sys.executable, '-c', code]+list(args), stderr=devnull,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    finally:
+        devnull.close()
+    if result != 0:
+        return None
+    return time.time()-started
+
+def handoff(filename):
+    '''time passing filename to an instance that's already running'''
+    name='bench-%d' % os.getpid()
+    pipe=SocketPipe(name)
+    pipe.listen()
+    try:
+        return run_python('import sys, main; from pipe import forward; '
+                          'sys.exit(not forward(sys.argv[1], sys.argv[2:]))',
+                          name, filename)
+    finally:
+        pipe.close()
+        os.rmdir(pipe.dir)
+
+def cold_start():
+    '''time loading everything needed to start the app for the first time'''
+    return run_python('import main, wx, wx.stc, notecomb, wxdoc')
+
+def result_key(result):
+    return result['name'], result['doc'], result['size'], result['sections']
+
+def format_result(result):
+    label=[result['name']]
+    if result['doc']:
+        label.append(result['doc'])
+    if result['size'] is not None:
+        label.append('size=%s' % format_size(result['size']))
+    if result['sections'] is not None:
+        label.append('sections=%d' % result['sections'])
+    text='%-56s %10.3fms' % (' '.join(label), result['seconds']*1000)
+    if result['ops'] > 1:
+        text += ' (%.2fus each)' % (result['seconds']*1e6/result['ops'])
+    return text
+
+def compare(results, baseline, threshold=1.2):
+    '''
+    (result, seconds before, ratio) for each result that is more than
+    threshold times slower than the same timing in the baseline (and
+    slower by more than MIN_DIFFERENCE)
+    '''
+    before=dict((result_key(result), result['seconds']) for result in baseline)
+    slower=[]
+    for result in results:
+        seconds=before.get(result_key(result))
+        if not seconds:
+            continue
+        ratio=result['seconds']/seconds
+        if ratio > threshold and result['seconds']-seconds > MIN_DIFFERENCE:
+            slower.append((result, seconds, ratio))
+    return slower
+
+def main(args=None):
+    parser=optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', default=None,
+                      help='save the results as json in this file')
+    parser.add_option('-b', '--baseline', default=None,
+                      help='compare with results saved earlier')
+    parser.add_option('-t', '--threshold', type='float', default=1.2,
+                      help='how many times slower than the baseline counts as slower (default 1.2)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='how many times to run each timing, taking the best (default 3)')
+    parser.add_option('-k', '--match', default=None,
+                      help='only run the timings with this in their name')
+    parser.add_option('--max-size', default=None,
+                      help='the biggest document to time (such as 1M)')
+    options, args=parser.parse_args(args)
+    sizes=SIZES
+    if options.max_size:
+        max_size=parse_size(options.max_size)
+        sizes=[size for size in SIZES if size <= max_size] or [max_size]
+    baseline=None
+    if options.baseline:
+        file=open(options.baseline)
+        try:
+            baseline=json.load(file)['results']
+        finally:
+            file.close()
+    bench=Bench(sizes, repeat=options.repeat, match=options.match)
+    try:
+        results=bench.run()
+    finally:
+        bench.close()
+    if options.output:
+        file=open(options.output, 'w')
+        try:
+            json.dump({
+                'python': sys.version.split()[0],
+                'platform': sys.platform,
+                'time': time.time(),
+                'results': results,
+            }, file, indent=1, sort_keys=True)
+        finally:
+            file.close()
+    if baseline is not None:
+        slower=compare(results, baseline, options.threshold)
+        if slower:
+            print('\nslower than the baseline:')
+            for result, seconds, ratio in slower:
+                print('  %s (was %.3fms, %.2fx)' % (format_result(result), seconds*1000, ratio))
+            return 1
+        print('\nnothing slower than the baseline')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,86 @@
 # based on http://www.valuedlessons.com/2008/04/events-in-python.html
 
+import weakref
+
+class WeakMethod(object):
+    '''a bound method that doesn't keep the object it's bound to alive'''
+
+    def __init__(self, method, callback=None):
+        self.ref=weakref.ref(method.__self__, callback)
+        self.func=method.__func__
+
+    def __call__(self):
+        '''the bound method, or None if the object has gone'''
+        obj=self.ref()
+        if obj is None:
+            return None
+        return self.func.__get__(obj, type(obj))
+
+def _is_bound_method(listener):
+    return getattr(listener, '__self__', None) is not None and hasattr(listener, '__func__')
+
 class Event(object):
-    def __init__(self):
-        self.listeners=set()
-    
+    '''
+    a list of listeners to call when something happens.  listeners that
+    are bound methods are only held weakly, and drop out once the object
+    they belong to has gone, so listening to a long lived object (like the
+    preferences) doesn't keep a closed window alive.
+
+    if post is given notifications are batched up: the first one since
+    the last dispatch posts a call to dispatch(), and the listeners are
+    then called just once, with a list of the arguments of each
+    notification in between.
+    '''
+
+    def __init__(self, post=None):
+        self.post=post
+        # key -> function giving the listener (or None once it's gone)
+        self._listeners={}
+        self._pending=[]
+
+    @property
+    def listeners(self):
+        listeners=[get() for get in list(self._listeners.values())]
+        return [listener for listener in listeners if listener is not None]
+
+    def _key(self, listener):
+        if _is_bound_method(listener):
+            return id(listener.__self__), listener.__func__
+        return listener
+
     def register(self, listener):
-        self.listeners.add(listener)
+        key=self._key(listener)
+        if _is_bound_method(listener):
+            listeners=self._listeners
+            self._listeners[key]=WeakMethod(listener, lambda ref: listeners.pop(key, None))
+        else:
+            self._listeners[key]=lambda: listener
         return self
-    
+
     def unregister(self, listener):
-        self.listeners.remove(listener)
+        del self._listeners[self._key(listener)]
         return self
-    
+
     def notify(self, *args, **kw):
+        if self.post is None:
+            self._call(args, kw)
+            return
+        if kw:
+            raise TypeError('batched events only take positional arguments')
+        self._pending.append(args)
+        if len(self._pending) == 1:
+            self.post(self.dispatch)
+
+    def dispatch(self):
+        '''call the listeners with any notifications that are waiting'''
+        pending, self._pending=self._pending, []
+        if pending:
+            self._call((pending,), {})
+
+    def _call(self, args, kw):
         for listener in self.listeners:
             listener(*args, **kw)
-    
+
     __call__ = notify
     __iadd__ = register
-    __isub__ = unregister
\ No newline at end of file
+    __isub__ = unregister
@@ -0,0 +1,103 @@
+'''
+a Fenwick (binary indexed) tree over a list of non-negative integers,
+giving O(log n) prefix sums, point updates and offset lookups
+'''
+
+class Fenwick(object):
+    def __init__(self, values=()):
+        self.rebuild(values)
+
+    def rebuild(self, values):
+        '''rebuild the tree from scratch in O(n)'''
+        self._values=list(values)
+        n=len(self._values)
+        tree=[0]+self._values
+        for i in range(1, n+1):
+            parent=i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self._tree=tree
+        self._top=1
+        while self._top*2 <= n:
+            self._top *= 2
+
+    def splice(self, start, values):
+        '''
+        replace the values from index start onwards, rebuilding only the
+        part of the tree that covers them, in O(n-start)
+        '''
+        del self._values[start:]
+        self._values.extend(values)
+        n=len(self._values)
+        tree=self._tree
+        del tree[start+1:]
+        tree.extend(self._values[start:])
+        # the nodes up to start that are part of the sums after it
+        i=start
+        while i > 0:
+            parent=i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+            i -= i & -i
+        for i in range(start+1, n+1):
+            parent=i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self._top=1
+        while self._top*2 <= n:
+            self._top *= 2
+
+    def __copy__(self):
+        fenwick=Fenwick.__new__(Fenwick)
+        fenwick._values=list(self._values)
+        fenwick._tree=list(self._tree)
+        fenwick._top=self._top
+        return fenwick
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, i):
+        return self._values[i]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def add(self, i, delta):
+        '''add delta to the value at index i'''
+        self._values[i] += delta
+        tree=self._tree
+        n=len(tree)
+        i += 1
+        while i < n:
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        '''sum of the first i values'''
+        total=0
+        tree=self._tree
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def total(self):
+        return self.prefix(len(self._values))
+
+    def find(self, offset):
+        '''
+        index i such that prefix(i) <= offset < prefix(i+1),
+        or len(self) if offset is past the end
+        '''
+        tree=self._tree
+        n=len(self._values)
+        pos=0
+        bit=self._top if n else 0
+        while bit:
+            next_pos=pos+bit
+            if next_pos <= n and tree[next_pos] <= offset:
+                pos=next_pos
+                offset -= tree[next_pos]
+            bit >>= 1
+        return pos
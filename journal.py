@@ -0,0 +1,244 @@
+import os
+import struct
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+'''
+an append-only journal of the edits made to a document's text since it
+was last saved, kept next to the file so they can be recovered after a
+crash.
+
+the journal starts with a header saying which version of the file (by
+size and modification time) the edits apply to, followed by a record for
+each edit: a byte for the kind of edit, the offset and length, and the
+text for inserts.  edits are buffered and written in batches, so typing
+only costs a few bytes on disk per key, however big the document is.
+the batches are written (and synced to disk) on a thread of their own,
+so the gui never waits for the disk.
+'''
+
+MAGIC=b'NCJ1'
+HEADER=struct.Struct('<4sQd')
+RECORD=struct.Struct('<cQI')
+
+INSERT=b'i'
+REMOVE=b'r'
+
+def journal_filename(filename):
+    dirname, basename=os.path.split(filename)
+    return os.path.join(dirname, '.%s.journal' % basename)
+
+def _file_stamp(filename):
+    try:
+        stat=os.stat(filename)
+    except OSError:
+        return 0, 0.0
+    return stat.st_size, stat.st_mtime
+
+def _encode(text):
+    if str is bytes:
+        return text
+    return text.encode('utf-8', 'surrogatepass')
+
+def _decode(data):
+    if str is bytes:
+        return data
+    return data.decode('utf-8', 'surrogatepass')
+
+class Journal(object):
+    # buffered edits are written once there are this many bytes of
+    # them, or this many seconds have gone by since the last write
+    BATCH_SIZE=4096
+    BATCH_TIME=1.0
+
+    clock=time.time
+
+    def __init__(self, filename):
+        self.filename=filename
+        self.path=journal_filename(filename)
+        self._base=_file_stamp(filename)
+        # bytes of edits written to the journal file (or on their way)
+        self._written=0
+        self._buffer=[]
+        self._buffered=0
+        self._last_flush=self.clock()
+        # the writer thread and what it uses
+        self._writer=None
+        self._queue=queue.Queue()
+        self._file=None
+        self._on_disk=0
+        self._error=None
+
+    def replay(self):
+        '''
+        the edits left in the journal from last time, as ('insert', offset,
+        text) or ('remove', offset, length), if it's for the file as it is
+        now.  any new edits are added on to the end.
+        '''
+        try:
+            file=open(self.path, 'rb')
+        except IOError:
+            return []
+        try:
+            data=file.read()
+        finally:
+            file.close()
+        if len(data) < HEADER.size:
+            return []
+        magic, size, mtime=HEADER.unpack_from(data)
+        if magic != MAGIC or (size, mtime) != self._base:
+            # the file has been changed since, so the edits don't apply
+            return []
+        edits=[]
+        pos=HEADER.size
+        while pos+RECORD.size <= len(data):
+            kind, offset, length=RECORD.unpack_from(data, pos)
+            end=pos+RECORD.size
+            if kind == INSERT:
+                if end+length > len(data):
+                    break
+                edits.append(('insert', offset, _decode(data[end:end+length])))
+                end += length
+            elif kind == REMOVE:
+                edits.append(('remove', offset, length))
+            else:
+                break
+            pos=end
+        # anything after the last whole edit was cut off part way through
+        # writing it, so carry on from there
+        self._written=self._on_disk=pos-HEADER.size
+        if pos < len(data):
+            file=open(self.path, 'r+b')
+            try:
+                file.truncate(pos)
+            finally:
+                file.close()
+        return edits
+
+    def insert(self, offset, text):
+        data=_encode(text)
+        self._append(RECORD.pack(INSERT, offset, len(data))+data)
+
+    def remove(self, offset, length):
+        self._append(RECORD.pack(REMOVE, offset, length))
+
+    def _append(self, record):
+        self._buffer.append(record)
+        self._buffered += len(record)
+        if self._buffered >= self.BATCH_SIZE or self.clock()-self._last_flush >= self.BATCH_TIME:
+            self.flush()
+
+    def position(self):
+        '''how far through the journal we are, to pass to saved() later'''
+        return self._written+self._buffered
+
+    def flush(self, wait=False):
+        '''
+        pass any buffered edits on to be written, and if wait is true,
+        wait for everything so far to be on disk
+        '''
+        self._last_flush=self.clock()
+        error, self._error=self._error, None
+        if self._buffer:
+            self._write(b''.join(self._buffer))
+            self._written += self._buffered
+            self._buffer=[]
+            self._buffered=0
+        if wait:
+            self._queue.join()
+            error=error or self._error
+            self._error=None
+        if error is not None:
+            raise error
+
+    def _write(self, data):
+        self._queue.put(data)
+        if self._writer is None:
+            self._writer=threading.Thread(target=self._work)
+            self._writer.daemon=True
+            self._writer.start()
+
+    def _work(self):
+        while True:
+            data=self._queue.get()
+            try:
+                if data is None:
+                    if self._file is not None:
+                        self._file.close()
+                        self._file=None
+                    return
+                if self._file is None:
+                    if self._on_disk:
+                        self._file=open(self.path, 'ab')
+                    else:
+                        self._file=open(self.path, 'wb')
+                        self._file.write(HEADER.pack(MAGIC, *self._base))
+                self._file.write(data)
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._on_disk += len(data)
+            except (IOError, OSError):
+                # passed on by the next flush()
+                self._error=sys.exc_info()[1]
+            finally:
+                self._queue.task_done()
+
+    def saved(self, position):
+        '''
+        the file has been saved with the edits up to position, so they can
+        be dropped.  any after that are kept, for the new version of the file.
+        '''
+        self.flush(wait=True)
+        tail=b''
+        if self._written > position:
+            file=open(self.path, 'rb')
+            try:
+                file.seek(HEADER.size+position)
+                tail=file.read()
+            finally:
+                file.close()
+        self.close()
+        self._base=_file_stamp(self.filename)
+        self._written=self._on_disk=len(tail)
+        if not tail:
+            self._remove()
+            return
+        temp_path=self.path+'.tmp'
+        file=open(temp_path, 'wb')
+        try:
+            file.write(HEADER.pack(MAGIC, *self._base))
+            file.write(tail)
+            file.flush()
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+        if hasattr(os, 'replace'):
+            os.replace(temp_path, self.path)
+        else:
+            self._remove()
+            os.rename(temp_path, self.path)
+
+    def discard(self):
+        '''throw the journal away'''
+        self.close()
+        self._buffer=[]
+        self._buffered=0
+        self._written=self._on_disk=0
+        self._error=None
+        self._remove()
+
+    def close(self):
+        '''stop the writer thread, once it's written everything passed to it'''
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer=None
+
+    def _remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,15 +1,35 @@
-import wx
-import wx.stc
-
+import os
+import socket
 import sys
 
-from notecomb import NoteCombFrame
-from wxdoc import DocApp
+from pipe import forward, pipe_name
 
-if __name__ == '__main__':
+APP_NAME='NoteComb'
+
+def main():
+    import wx
+    import wx.stc
+    
+    from notecomb import NoteCombFrame
+    from wxdoc import DocApp
+    
     class App(DocApp):
-        __APP_NAME__='NoteComb'
+        __APP_NAME__=APP_NAME
         __DOC_FRAME__=NoteCombFrame
         
     app=App(redirect=False)
-    app.MainLoop()
\ No newline at end of file
+    app.MainLoop()
+
+if __name__ == '__main__':
+    # if we're already running just pass the files on, without waiting
+    # to load wx.  the running instance may have a different current
+    # directory, so the filenames need to be absolute
+    files=[os.path.abspath(filename) for filename in sys.argv[1:]]
+    try:
+        forwarded=forward(pipe_name(APP_NAME), files)
+    except socket.timeout:
+        # starting another copy wouldn't help, as it would try to
+        # hand the files over to the stuck one too
+        sys.exit("%s is already running, but isn't responding" % APP_NAME)
+    if not forwarded:
+        main()
@@ -1,17 +1,49 @@
+from bisect import bisect_left, bisect_right
+from collections import deque
 from copy import copy
 from difflib import SequenceMatcher
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from fenwick import Fenwick
+from journal import Journal
+from rope import MappedFile, Rope
+from wordindex import WordIndex
 
 class Document(object):
-    def __init__(self):
-        self._text=''
+    # files at least this big are memory mapped when they're opened
+    MAP_FILE_SIZE=8*1024*1024
+    # keep a journal of unsaved edits next to the file, so they can
+    # be recovered when it's next opened if we crash before saving
+    JOURNAL=False
+    
+    def __init__(self, indexed=False):
+        # keep an index of the words in the text, to speed up searching
+        # large documents at the cost of some memory
+        self.indexed=indexed
+        # bumped whenever the underlying text changes
+        self._version=0
+        self._rope=self._new_rope('')
         self.filename=None
+        # the version of the text last written to the file, and a lock
+        # around writing it as that can happen on another thread
+        self._written_version=0
+        self._save_lock=threading.Lock()
+        self._journal=None
         self.is_modified=False
         self._initial_state()
     
     def _initial_state(self):
         self.current_offset=0
         self.current_search=''
-        self._visible=[self.Visible(0,len(self._text))]
+        self._visible=VisibleSections([self.Visible(0,len(self._rope))])
+        # (search words, matching spans) for each search typed in so far
+        # that narrowed down the one before it
+        self._search_stack=[]
     
     @property
     def is_saved(self):
@@ -23,156 +55,421 @@ class Document(object):
     
     def save(self):
         if self.filename:
-            file=open(self.filename,'w')
-            try:
-                file.write(self._text)
-                self.is_modified=False
-            finally:
-                file.close()
+            job=self.save_job()
+            job.run()
+            self.saved(job)
+    
+    def save_job(self):
+        '''
+        a SaveJob for saving the text as it is now.  it can be run on
+        another thread while the document carries on being edited, then
+        passed to saved() back on this one
+        '''
+        return SaveJob(self)
+    
+    def saved(self, job):
+        if not job.written:
+            return
+        if self.JOURNAL and job.filename == self.filename:
+            journal=self._journal
+            if journal is not None and journal.filename == job.filename:
+                journal.saved(job.journal_position)
+            else:
+                # saved under a new name
+                if journal is not None:
+                    journal.discard()
+                self._journal=Journal(job.filename)
+        # only up to date if nothing has changed since the job started
+        if job.version == self._version and job.filename == self.filename:
+            self.is_modified=False
+    
+    def flush_journal(self, wait=False):
+        '''
+        start writing any edits still waiting to go in the journal, and if
+        wait is true wait until they're on disk
+        '''
+        if self._journal is not None:
+            self._journal.flush(wait)
+    
+    def revert(self):
+        '''throw away any changes and open the file again'''
+        self._discard_journal()
+        self.open(self.filename)
+    
+    def close(self):
+        '''
+        finished with the document.  any changes that haven't been saved
+        are meant to be lost, so they aren't kept for recovery either
+        '''
+        self._discard_journal()
+    
+    def _discard_journal(self):
+        if self._journal is not None:
+            self._journal.discard()
+            self._journal=None
     
     def save_as(self, filename):
         self.filename=filename
         self.save()
     
-    def open(self, filename):
-        file=open(filename,'rU')
+    def open(self, filename, mapped=None):
+        '''
+        open a file.  big files (or any file, if mapped is True) are memory
+        mapped rather than read in, so only the parts that have been edited
+        are held in memory
+        '''
+        if mapped is None:
+            mapped=os.path.getsize(filename) >= self.MAP_FILE_SIZE
+        if mapped:
+            file=open(filename,'rb')
+        else:
+            file=open(filename,'rU' if str is bytes else 'r')
         try:
-            self._text=file.read()
-            self.is_modified=False
+            if mapped:
+                self._rope=self._map_rope(file)
+            else:
+                self._rope=self._new_rope(file.read())
+            self._version += 1
+            self.is_modified=self._open_journal(filename)
             self._initial_state()
             self.filename=filename
         finally:
             file.close()
     
-    def search(self,q):
+    def _open_journal(self, filename):
+        '''
+        start a journal for the file just opened, putting back any edits
+        left in it from last time.  returns whether there were any
+        '''
+        if self._journal is not None:
+            self._journal.close()
+            self._journal=None
+        if not self.JOURNAL:
+            return False
+        self._journal=Journal(filename)
+        recovered=False
+        for kind, offset, arg in self._journal.replay():
+            if kind == 'insert' and 0 <= offset <= len(self._rope):
+                self._rope.insert(offset, arg)
+            elif kind == 'remove' and 0 <= offset and offset+arg <= len(self._rope):
+                self._rope.remove(offset, arg)
+            else:
+                break
+            recovered=True
+        return recovered
+    
+    def _map_rope(self, file):
+        try:
+            mapping=mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped
+            return self._new_rope('')
+        return Rope.mapped(MappedFile(mapping), WordIndex() if self.indexed else None)
+    
+    def _new_rope(self, text):
+        return Rope(text, WordIndex() if self.indexed else None)
+    
+    def search(self, q, job=None):
         if q:
-            self._visible=[]
-            offset=0
-            search_words=[w.lower() for w in q.split()]
-            # TODO merge visible lines together
-            for line in self._text.splitlines(True):
-                if self._line_matches(line, search_words):
-                    length = len(line)
-                    self._visible.append(self.Visible(offset,length))
-                offset += len(line)
-            if not self._visible:
-                self._visible.append(self.Visible(0,0))
+            # use the results of a search that has already been run
+            # (eg in the background) if they are still up to date
+            if job is None or job.q != q or job.version != self._version:
+                job=self.search_job(q)
+                job.run()
+            self._search_stack=job.stack+[(job.search_words, job.spans)]
+            visible=[self.Visible(offset,length) for offset, length in job.spans]
+            if not visible:
+                visible.append(self.Visible(0,0))
             else:
                 # make the last visible section's line ending not visible
                 # so we don't get an empty line showing int he search results
-                last_visible=self._visible[-1]
-                text=last_visible.text(self._text)
-                if text.endswith("\n"):
+                last_visible=visible[-1]
+                if last_visible.last_char(self._rope) == "\n":
                     last_visible.length -=1
+            self._set_visible(VisibleSections(visible))
         else:
-            self._visible=[self.Visible(0,len(self._text))]
+            self._set_visible(VisibleSections([self.Visible(0,len(self._rope))]))
         self.current_search=q
         self.current_offset=0
     
-    def _line_matches(self, line, search_words):
-        lc_line=line.lower()
-        for word in search_words:
-            if not word in lc_line:
-                return False
-        return True
+    def search_job(self, q, snapshot=False):
+        '''
+        a search for q that can be run separately and then passed to search().
+        with snapshot set it works on a snapshot of the text, so can be run
+        on another thread while the document carries on being edited
+        '''
+        return SearchJob(self, q, snapshot)
+    
+    @property
+    def visible_sections(self):
+        '''
+        the current visible sections.  searching replaces them rather than
+        changing them, so they can be kept to compare against afterwards
+        '''
+        return self._visible
+    
+    def visible_changes(self, previous):
+        '''
+        the deletions and insertions that turn the text visible in the
+        previous sections into the current visible text (assuming the
+        underlying text hasn't changed in between).  returns a list of
+        ('delete', offset, length) and ('insert', offset, text), with offsets
+        into the visible text as it is after applying the changes before
+        '''
+        old=[(offset, offset+length) for offset, length in previous.sections() if length]
+        new=[(offset, offset+length) for offset, length in self._visible.sections() if length]
+        bounds=sorted(set(offset for section in old+new for offset in section))
+        changes=[]
+        pos=0
+        i=j=0
+        for start, end in zip(bounds, bounds[1:]):
+            while i < len(old) and old[i][1] <= start:
+                i += 1
+            while j < len(new) and new[j][1] <= start:
+                j += 1
+            in_old=i < len(old) and old[i][0] <= start
+            in_new=j < len(new) and new[j][0] <= start
+            length=end-start
+            if in_old and in_new:
+                pos += length
+            elif in_old:
+                if changes and changes[-1][0] == 'delete' and changes[-1][1] == pos:
+                    changes[-1][2] += length
+                else:
+                    changes.append(['delete', pos, length])
+            elif in_new:
+                text=self._rope[start:end]
+                if changes and changes[-1][0] == 'insert' and changes[-1][1]+len(changes[-1][2]) == pos:
+                    changes[-1][2] += text
+                else:
+                    changes.append(['insert', pos, text])
+                pos += length
+        return [tuple(change) for change in changes]
+    
+    @property
+    def view(self):
+        '''the visible text, without copying it out of the document'''
+        return VisibleText(self)
     
     @property
     def visible_text(self):
-        return ''.join(v.text(self._text) for v in self._visible)
+        return ''.join(self.view.chunks())
     
     @property
     def text(self):
-        return self._text
+        return self._rope[:]
     
     def insert(self, offset, text):
-        visible_offset, visible, other_visible = self._find_visible_from_offset(offset)
-        actual_offset=visible.offset + (offset-visible_offset)
+        self._insert(offset, text)
+        self.current_offset=offset+len(text)
+        self.is_modified=True
+    
+    def _insert(self, offset, text):
+        i, visible_offset = self._find_visible_from_offset(offset)
+        actual_offset=self._visible.offset(i) + (offset-visible_offset)
         self._insert_text(actual_offset, text)
         length=len(text)
-        visible.length += length
+        self._resize_visible(i,length)
         # shift other visible sections along by same amount
-        self._move_visible(other_visible,length)
-        
-        self.current_offset=offset+len(text)
-        self.is_modified=True
+        self._shift_visible(i+1,length)
     
     def _find_visible_from_offset(self,offset):
-        visible_offset=0
-        for i, visible in enumerate(self._visible):
-            if visible_offset <= offset <= visible_offset+visible.length:
-                return visible_offset, visible, self._visible[i+1:]
-            visible_offset += visible.length
-        raise ValueError("invalid offset %d" % offset)
-    
-    def _move_visible(self,visible,length):
-        for v in visible:
-            v.offset += length
+        '''index and visible offset of the first visible section containing offset'''
+        i=self._visible.find(offset)
+        return i, self._visible.visible_offset(i)
     
     def remove(self, offset, length):
+        touched=self._remove(offset, length)
+        if touched:
+            # only the sections text was removed from can need merging
+            self._merge_visible(*touched)
+        else:
+            self._merge_visible()
+        
+        self.current_offset=offset
+        self.is_modified=True
+    
+    def _remove(self, offset, length):
+        '''
+        remove text without merging the sections left behind, returning
+        the indexes of the first and last sections it was removed from
+        '''
         length_removed=0
+        first=None
         while length:
-            visible_offset, visible, other_visible = self._find_visible_from_offset(offset+1)
-            actual_offset=visible.offset + (offset-visible_offset)
+            i, visible_offset = self._find_visible_from_offset(offset+1)
+            if first is None:
+                first=i
+            actual_offset=self._visible.offset(i) + (offset-visible_offset)
         
             # how much we can remove from this visible section
-            length_removed=min(length, visible.length-(offset-visible_offset))
+            length_removed=min(length, self._visible.length(i)-(offset-visible_offset))
             self._remove_text(actual_offset, length_removed)
-            visible.length -= length_removed
+            self._resize_visible(i,-length_removed)
         
-            self._move_visible(other_visible,-length_removed)
+            self._shift_visible(i+1,-length_removed)
             
             length -= length_removed
-        self._merge_visible()
+        if first is not None:
+            return first, i
+    
+    def apply_edits(self, edits):
+        '''
+        make a batch of edits at once.  each edit is ('insert', offset, text)
+        or ('remove', offset, length), with the offsets all into the visible
+        text as it is before any of them are made.  removes can't overlap
+        each other, or have inserts inside them.  either every edit is made,
+        or (if there's a problem) none of them are.
+        '''
+        edits=self._check_edits(edits)
+        if not edits:
+            return
+        checkpoint=Checkpoint(self)
+        try:
+            # starting from the end, so the offsets of the edits
+            # still to do don't change
+            first=last=None
+            for kind, offset, arg in reversed(edits):
+                if kind == 'insert':
+                    self._insert(offset, arg)
+                else:
+                    touched=self._remove(offset, arg)
+                    if touched:
+                        if last is None:
+                            last=touched[1]
+                        first=touched[0]
+            if first is not None:
+                self._merge_visible(first, last)
+        except:
+            checkpoint.restore(self)
+            raise
         
-        self.current_offset=offset
+        # leave the cursor after the last edit
+        kind, offset, arg=edits[-1]
+        delta=sum(len(a) if k == 'insert' else -a for k, o, a in edits[:-1])
+        self.current_offset=offset+delta+(len(arg) if kind == 'insert' else 0)
         self.is_modified=True
     
+    def _check_edits(self, edits):
+        '''the edits in the order to make them, or ValueError if any are invalid'''
+        length=self._visible.total()
+        checked=[]
+        for edit in edits:
+            kind, offset, arg=edit
+            if kind == 'insert':
+                end=offset
+                if not arg:
+                    continue
+            elif kind == 'remove':
+                end=offset+arg
+                if arg < 0:
+                    raise ValueError("invalid remove %r" % (edit,))
+                if not arg:
+                    continue
+            else:
+                raise ValueError("unknown edit %r" % (edit,))
+            if not 0 <= offset <= end <= length:
+                raise ValueError("edit out of range %r" % (edit,))
+            checked.append((kind, offset, arg))
+        # inserts go before any remove at the same offset, and the
+        # order of inserts at the same offset is kept
+        checked.sort(key=lambda edit: (edit[1], edit[0] == 'remove'))
+        end=0
+        for kind, offset, arg in checked:
+            if offset < end:
+                raise ValueError("overlapping edit %r" % ((kind, offset, arg),))
+            if kind == 'remove':
+                end=offset+arg
+        return checked
+    
     def _remove_text(self, offset, length):
         '''remove text from the underlying text'''
-        self._text=self._text[:offset]+self._text[offset+length:]
+        self._rope.remove(offset, length)
+        if self._journal is not None:
+            self._journal.remove(offset, length)
+        self._version += 1
+        self._search_stack=[]
     
     def _insert_text(self, offset, text):
         '''insert text into underlying text'''
-        self._text=self._text[:offset]+text+self._text[offset:]
+        self._rope.insert(offset, text)
+        if self._journal is not None:
+            self._journal.insert(offset, text)
+        self._version += 1
+        self._search_stack=[]
     
-    def _move_text(self,from_offset,to_offset,length):
-        text=self._text[from_offset:from_offset+length]
-        self._remove_text(from_offset, length)
-        self._insert_text(to_offset, text)
-
+    def _set_visible(self, visible):
+        '''replace all of the visible sections'''
+        self._visible=visible
+    
+    def _resize_visible(self, i, delta):
+        self._visible.resize(i, delta)
     
-    def _merge_visible(self):
+    def _shift_visible(self, i, delta):
+        '''move visible section i and all the ones after it along the underlying text'''
+        self._visible.shift(i, delta)
+    
+    def _insert_visible(self, spans):
+        '''insert lists of (offset, length) sections, given as (index, sections) in order'''
+        self._visible.insert(spans)
+    
+    def _delete_visible(self, spans):
+        '''delete the sections in each (start, stop) span (not including stop), given in order'''
+        self._visible.delete(spans)
+    
+    def _merge_visible(self, start=0, end=None):
         # any visible lines that are now joined together,
-        # should be joined together in the real underlying text
-        while True:
-            merged=False
-            for i, visible in enumerate(self._visible[:-1]):
-                text=visible.text(self._text)
-                if not text.endswith("\n"):
-                    merged=True
-                    other_visible=self._visible[i+1]
-                    other_length=other_visible.length
-                    self._move_text(other_visible.offset, visible.offset+visible.length, other_length)
-                    
-                    self._visible.remove(other_visible)
-                    
-                    visible.length += other_length
-                    self._move_visible(self._visible[i+1:], other_length)
-                    
-                    break
-            if not merged:
-                # make sure there's a newline after the last visible section (if there's more text after it)
-                last_visible=self._visible[-1]
-                text=last_visible.text(self._text)
-                if not text.endswith("\n"):
-                    last_offset=last_visible.offset+last_visible.length
-                    # check if more text after visible and not empty
-                    if last_offset < len(self._text) and not last_visible.is_empty:
-                        text_after=self._text[last_offset:]
-                        if not text_after.startswith("\n"):
-                            self._insert_text(last_offset, "\n")
-                return
+        # should be joined together in the real underlying text.
+        # a section that no longer ends a line takes the text of the
+        # sections after it, up to the next one that does end a line.
+        # only sections start to end (inclusive) are checked.
+        if end is None:
+            end=len(self._visible)
+        # the sections merged into others, deleted together at the end
+        spans=[]
+        i=start
+        while i <= end and i < len(self._visible)-1:
+            if self._ends_line(i):
+                i += 1
+                continue
+            stop=i+1
+            while stop < len(self._visible)-1 and not self._ends_line(stop):
+                stop += 1
+            text_end=self._visible.end(i)
+            # take the text out from the back, so the offsets of the
+            # sections still to do don't change
+            pieces=[]
+            for j in range(stop, i, -1):
+                other_offset=self._visible.offset(j)
+                other_length=self._visible.length(j)
+                if other_length:
+                    pieces.append(self._rope[other_offset:other_offset+other_length])
+                    self._remove_text(other_offset, other_length)
+            pieces.reverse()
+            text=''.join(pieces)
+            # putting it back straight after section i means the
+            # sections after stop end up where they started
+            if text:
+                self._insert_text(text_end, text)
+            self._resize_visible(i, len(text))
+            spans.append((i+1, stop+1))
+            i=stop+1
+        if spans:
+            self._delete_visible(spans)
+        # make sure there's a newline after the last visible section (if there's more text after it)
+        last=len(self._visible)-1
+        if not self._ends_line(last):
+            last_offset=self._visible.end(last)
+            # check if more text after visible and not empty
+            if last_offset < len(self._rope) and self._visible.length(last):
+                text_after=self._rope[last_offset:last_offset+1]
+                if not text_after.startswith("\n"):
+                    self._insert_text(last_offset, "\n")
     
+    def _ends_line(self, i):
+        '''whether visible section i ends with a newline'''
+        end=self._visible.end(i)
+        return self._visible.length(i) > 0 and self._rope[end-1:end] == "\n"
     
     class Visible(object):
         def __init__(self,offset,length):
@@ -182,52 +479,667 @@ class Document(object):
         def text(self,text):
             return text[self.offset:self.offset+self.length]
         
+        def last_char(self,text):
+            if self.is_empty:
+                return ''
+            end=self.offset+self.length
+            return text[end-1:end]
+        
         @property
         def is_empty(self):
             return self.length == 0
 
+class SaveJob(object):
+    '''
+    saves a snapshot of a document's text.  the text is written to a
+    temporary file that is then renamed over the real one, so a crash part
+    way through never leaves half a file behind.
+    '''
+    
+    def __init__(self, doc):
+        self.filename=doc.filename
+        self.version=doc._version
+        self.written=False
+        # the edits that will be saved, out of those in the journal
+        self.journal_position=doc._journal.position() if doc._journal is not None else 0
+        self._doc=doc
+        self._rope=doc._rope.snapshot()
+    
+    def run(self):
+        # write to where a symlink points, rather than replacing the link
+        path=os.path.realpath(self.filename)
+        dirname, basename=os.path.split(path)
+        fd, temp_filename=tempfile.mkstemp(prefix='.'+basename, dir=dirname)
+        try:
+            file=os.fdopen(fd, 'w')
+            try:
+                for chunk in self._rope.chunks():
+                    file.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+            finally:
+                file.close()
+            if os.path.exists(path):
+                shutil.copymode(path, temp_filename)
+            else:
+                # mkstemp only lets us read and write it
+                os.chmod(temp_filename, 0o666 & ~_UMASK)
+            doc=self._doc
+            doc._save_lock.acquire()
+            try:
+                # don't go back to older text if a later save has already
+                # finished (eg saving by hand while an auto-save is running)
+                if self.version < doc._written_version:
+                    os.remove(temp_filename)
+                    return
+                # if the file is memory mapped the mapping stays valid
+                # until nothing refers to it
+                _replace_file(temp_filename, path)
+                doc._written_version=self.version
+                self.written=True
+            finally:
+                doc._save_lock.release()
+        except:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+        _sync_dir(dirname)
+
+def _get_umask():
+    # the only way to read it is to change it, so do it once up front
+    # rather than racing with other threads later
+    umask=os.umask(0)
+    os.umask(umask)
+    return umask
+
+_UMASK=_get_umask()
+
+def _replace_file(source, destination):
+    if hasattr(os, 'replace'):
+        os.replace(source, destination)
+    elif os.name == 'nt' and os.path.exists(destination):
+        os.remove(destination)
+        os.rename(source, destination)
+    else:
+        os.rename(source, destination)
+
+def _sync_dir(dirname):
+    '''make sure a rename in the directory has made it to disk, where possible'''
+    try:
+        fd=os.open(dirname, os.O_RDONLY)
+    except (OSError, AttributeError):
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def search_words(q):
+    '''the (lower case) words that a search is for'''
+    return [w.lower() for w in q.split()]
+
+def line_matches(line, search_words):
+    '''whether a line contains all of the search words, ignoring case'''
+    lc_line=line.lower()
+    for word in search_words:
+        if not word in lc_line:
+            return False
+    return True
+
+def matching_lines(text, starts, search_words, lo=0, hi=None):
+    '''
+    start and end of each line in text[lo:hi] with all of the search words,
+    given the offsets of the start of each line in text (see line_starts)
+    '''
+    length=len(text)
+    if hi is None:
+        hi=length
+    if lo or hi < length:
+        lc_text=text[lo:hi].lower()
+    else:
+        lc_text=text.lower()
+    if not search_words or len(lc_text) != hi-lo:
+        # lower casing has changed the length (or there's nothing to
+        # look for) so just check each line in turn
+        for i in range(bisect_right(starts, lo)-1, bisect_left(starts, hi)):
+            start=max(starts[i], lo)
+            end=min(starts[i+1] if i+1 < len(starts) else length, hi)
+            if line_matches(text[start:end], search_words):
+                yield start, end
+        return
+    # look for the longest word first, as it's likely to be the rarest,
+    # then only check the lines it's in for the other words
+    words=sorted(search_words, key=len, reverse=True)
+    first_word, other_words=words[0], words[1:]
+    pos=lc_text.find(first_word)
+    while pos != -1:
+        i=bisect_right(starts, pos+lo)-1
+        start=max(starts[i], lo)
+        end=min(starts[i+1] if i+1 < len(starts) else length, hi)
+        for word in other_words:
+            if lc_text.find(word, start-lo, end-lo) == -1:
+                break
+        else:
+            yield start, end
+        pos=lc_text.find(first_word, end-lo)
+
+class SearchJob(object):
+    '''
+    works out the lines matching a search.  everything that needs the
+    document itself is done up front, so run() only reads the text.
+    '''
+    
+    def __init__(self, doc, q, snapshot=False):
+        self.q=q
+        self.search_words=search_words(q)
+        self.version=doc._version
+        self.spans=None
+        self._rope=doc._rope.snapshot() if snapshot else doc._rope
+        self._ranges=None
+        self._chunks=None
+        
+        # reuse the results of the last search this one narrows down, or
+        # if it's the same search then just use its results directly
+        stack=list(doc._search_stack)
+        while stack and not self._narrows(stack[-1][0], self.search_words):
+            stack.pop()
+        if stack:
+            previous_words, previous_spans=stack[-1]
+            if sorted(previous_words) == sorted(self.search_words):
+                stack.pop()
+                self.spans=previous_spans
+            else:
+                self._ranges=previous_spans
+        elif doc._rope.index is not None:
+            candidates=doc._rope.index.lookup(self.search_words)
+            if candidates is not None:
+                self._chunks=doc._rope.locate(candidates)
+        # the earlier searches this one follows on from
+        self.stack=stack
+    
+    def run(self, cancelled=None):
+        '''
+        find the spans of matching lines, checking cancelled() as it goes.
+        returns False if it was cancelled before finishing
+        '''
+        if self.spans is not None:
+            return True
+        spans=list(self._join_lines(self._matching_lines(cancelled)))
+        if cancelled is not None and cancelled():
+            return False
+        self.spans=spans
+        return True
+    
+    def _join_lines(self, lines):
+        '''join runs of consecutive lines together into single spans'''
+        span_offset, span_end=None, None
+        for offset, length in lines:
+            if offset != span_end:
+                if span_offset is not None:
+                    yield span_offset, span_end-span_offset
+                span_offset=offset
+            span_end=offset+length
+        if span_offset is not None:
+            yield span_offset, span_end-span_offset
+    
+    def _narrows(self, previous_words, search_words):
+        # a line can only have all the new words in it if it had all the
+        # old ones, when each old word is part of one of the new words
+        for previous_word in previous_words:
+            for word in search_words:
+                if previous_word in word:
+                    break
+            else:
+                return False
+        return True
+    
+    def _matching_lines(self, cancelled):
+        '''offset and length of every line containing all of the search words'''
+        if self._ranges is not None:
+            pieces=self._chunk_pieces(self._ranges)
+        else:
+            chunks=self._chunks
+            if chunks is None:
+                chunks=self._rope.iter_chunks()
+            pieces=((offset, chunk, 0, len(chunk)) for offset, chunk in chunks)
+        # chunks always hold whole lines, so can be searched on their own
+        for chunk_offset, chunk, lo, hi in pieces:
+            if cancelled is not None and cancelled():
+                return
+            for start, end in matching_lines(chunk.text, chunk.line_starts, self.search_words, lo, hi):
+                yield chunk_offset+start, end-start
+    
+    def _chunk_pieces(self, ranges):
+        for offset, length in ranges:
+            for chunk_offset, chunk in self._rope.iter_chunks(offset, offset+length):
+                lo=max(offset-chunk_offset, 0)
+                hi=min(offset+length-chunk_offset, len(chunk))
+                yield chunk_offset, chunk, lo, hi
+    
+class VisibleSections(object):
+    '''
+    the visible sections of a document, in order.  the section lengths are
+    kept in a Fenwick tree, so finding a section from a visible offset is
+    O(log n), and the offsets are stored along with a second tree of
+    deltas, so that shifting every section after a point is O(log n) too
+    '''
+    
+    def __init__(self, visible=()):
+        self._rebuild([(v.offset, v.length) for v in visible])
+    
+    def _rebuild(self, sections):
+        self._offsets=[offset for offset, length in sections]
+        self._lengths=Fenwick(length for offset, length in sections)
+        self._shifts=Fenwick([0]*len(sections))
+    
+    def __len__(self):
+        return len(self._offsets)
+    
+    def __iter__(self):
+        for offset, length in self.sections():
+            yield Document.Visible(offset, length)
+    
+    def __copy__(self):
+        return VisibleSections(self)
+    
+    def sections(self, start=0):
+        '''iterate over (offset, length) of each section from index start'''
+        shift=self._shifts.prefix(start)
+        for i in range(start, len(self._offsets)):
+            shift += self._shifts[i]
+            yield self._offsets[i]+shift, self._lengths[i]
+    
+    def offset(self, i):
+        return self._offsets[i]+self._shifts.prefix(i+1)
+    
+    def length(self, i):
+        return self._lengths[i]
+    
+    def end(self, i):
+        return self.offset(i)+self.length(i)
+    
+    def visible_offset(self, i):
+        return self._lengths.prefix(i)
+    
+    def total(self):
+        return self._lengths.total()
+    
+    def locate(self, offset):
+        '''index of the section holding the character at the visible offset'''
+        return self._lengths.find(offset)
+    
+    def find(self, offset):
+        '''index of the first section that contains the visible offset'''
+        if 0 < offset <= self._lengths.total():
+            return self._lengths.find(offset-1)
+        elif offset == 0 and self._offsets:
+            return 0
+        raise ValueError("invalid offset %d" % offset)
+    
+    def resize(self, i, delta):
+        self._lengths.add(i, delta)
+    
+    def shift(self, i, delta):
+        '''move the offsets of section i and all the sections after it'''
+        if i < len(self._offsets):
+            self._shifts.add(i, delta)
+    
+    def insert(self, spans):
+        '''
+        insert lists of (offset, length) sections, given as (index, sections)
+        in order, where each index is where they end up.  only the sections
+        from the first index on are rebuilt
+        '''
+        if not spans:
+            return
+        first=spans[0][0]
+        offsets, lengths, shifts=[], [], []
+        old=first
+        for start, sections in spans:
+            count=start-first-len(offsets)
+            offsets.extend(self._offsets[old:old+count])
+            lengths.extend(self._lengths[old:old+count])
+            shifts.extend(self._shifts[old:old+count])
+            old += count
+            # new sections don't move with the ones before them
+            shift=self._shifts.prefix(old)
+            offsets.extend(offset-shift for offset, length in sections)
+            lengths.extend(length for offset, length in sections)
+            shifts.extend([0]*len(sections))
+        offsets.extend(self._offsets[old:])
+        lengths.extend(self._lengths[old:])
+        shifts.extend(self._shifts[old:])
+        self._offsets[first:]=offsets
+        self._lengths.splice(first, lengths)
+        self._shifts.splice(first, shifts)
+    
+    def delete(self, spans):
+        '''
+        delete the sections in each (start, stop) span, given in order.
+        only the sections after the first one deleted are rebuilt
+        '''
+        if not spans:
+            return
+        n=len(self._offsets)
+        for start, stop in spans:
+            # the sections after still move by the shifts of those deleted
+            if stop < n:
+                self._shifts.add(stop, self._shifts.prefix(stop)-self._shifts.prefix(start))
+        # the runs of sections between the spans, that are kept
+        kept=[(stop, next_start) for (start, stop), (next_start, next_stop)
+                in zip(spans, spans[1:]+[(n, n)])]
+        def keep(values):
+            tail=[]
+            for start, stop in kept:
+                tail.extend(values[start:stop])
+            return tail
+        first=spans[0][0]
+        self._offsets[first:]=keep(self._offsets)
+        self._lengths.splice(first, keep(self._lengths))
+        self._shifts.splice(first, keep(self._shifts))
+
+class VisibleText(object):
+    '''
+    a read only view of a document's visible text, that reads it straight
+    out of the document as needed rather than joining it all together
+    '''
+    
+    def __init__(self, doc):
+        self._doc=doc
+    
+    def __len__(self):
+        return self._doc._visible.total()
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step=index.indices(len(self))
+            if step != 1:
+                raise ValueError("visible text slices do not support steps")
+            return ''.join(self.chunks(start, stop))
+        length=len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("visible text index out of range")
+        return self[index:index+1]
+    
+    def chunks(self, start=0, end=None):
+        '''iterate over the visible text between start and end a piece at a time'''
+        if end is None:
+            end=len(self)
+        if start >= end:
+            return
+        sections=self._doc._visible
+        rope=self._doc._rope
+        i=sections.locate(start)
+        visible_offset=sections.visible_offset(i)
+        for offset, length in sections.sections(i):
+            if visible_offset >= end:
+                break
+            lo=max(start-visible_offset, 0)
+            hi=min(end-visible_offset, length)
+            for chunk in rope.chunks(offset+lo, offset+hi):
+                yield chunk
+            visible_offset += length
+    
+    def lines(self, start=0, end=None):
+        '''iterate over the visible lines between start and end, with their line endings'''
+        partial=[]
+        for chunk in self.chunks(start, end):
+            pos=0
+            i=chunk.find('\n')
+            while i != -1:
+                partial.append(chunk[pos:i+1])
+                yield ''.join(partial)
+                partial=[]
+                pos=i+1
+                i=chunk.find('\n', pos)
+            if pos < len(chunk):
+                partial.append(chunk[pos:])
+        if partial:
+            yield ''.join(partial)
+
+def apply_visible_changes(text_ctrl, changes):
+    '''apply the changes from Document.visible_changes to a StyledTextCtrl'''
+    for change, offset, value in changes:
+        if change == 'delete':
+            text_ctrl.SetTargetStart(offset)
+            text_ctrl.SetTargetEnd(offset+value)
+            text_ctrl.ReplaceTarget('')
+        else:
+            text_ctrl.InsertText(offset, value)
+
 def undoable(description):
     def _decorator(fn):
         def _decorated(self,*args):
-            self.current_undo=UndoAction(self, description)
-            fn(self, *args)
-            self.current_undo.update_redo(self)
-            self.undos.append(self.current_undo)
-            self.redos=[]
-            self.current_undo=None
+            self.current_undo=UndoAction(self, description, args)
+            try:
+                fn(self, *args)
+                self.current_undo.update_redo(self)
+                self._push_undo(self.current_undo)
+            finally:
+                self.current_undo=None
         return _decorated
     return _decorator
 
 
 class UndoableDocument(Document):
+    JOURNAL=True
+    
+    # the oldest undos are thrown away once there are more than
+    # this many, or once they take up more than this many bytes
+    MAX_UNDOS=10000
+    MAX_UNDO_SIZE=16*1024*1024
+    # typing or deleting a character at a time within this many seconds
+    # of the last one is undone along with it (zero to turn off)
+    COALESCE_TIMEOUT=1.0
+    # a copy of the whole document is kept every this many undos, so
+    # jumping around the history never replays more than about this many
+    CHECKPOINT_INTERVAL=50
+    
+    clock=time.time
 
-    def __init__(self):
-        super(UndoableDocument,self).__init__()
-        self.undos=[]
-        self.redos=[]
+    def __init__(self, indexed=False):
+        super(UndoableDocument,self).__init__(indexed)
         self.current_undo=None
+        self._reset_undos()
+    
+    def _reset_undos(self):
+        self._root=UndoNode(None, None, self.clock())
+        self._root.checkpoint=Checkpoint(self)
+        self._current=self._root
+        # the nodes from the root to the current one
+        self._path=deque([self._root])
+        # (time, node) for each time the current node changed
+        self._timeline=[(self._root.time, self._root)]
+        self._undo_count=0
+        self._undo_size=self._root.checkpoint.size
+        self._can_coalesce=False
+    
+    def open(self, filename, mapped=None):
+        super(UndoableDocument,self).open(filename, mapped)
+        self._reset_undos()
+    
+    @property
+    def undo_root(self):
+        '''the oldest point in the undo history that can be returned to'''
+        return self._root
+    
+    @property
+    def undo_node(self):
+        '''the point in the undo history the document is currently at'''
+        return self._current
     
     def can_undo(self):
-        return len(self.undos) > 0
+        return self._current.parent is not None
     
     def can_redo(self):
-        return len(self.redos) > 0
+        return self._current.redo_child is not None
     
     def undo(self):
         if self.can_undo():
-            last_undo,self.undos=self.undos[-1],self.undos[:-1]
-            last_undo.undo(self)
-            self.redos.append(last_undo)
+            node=self._current
+            node.action.undo(self)
+            node.parent.redo_child=node
+            self._path.pop()
+            self._move_to(node.parent)
     
     def redo(self):
         if self.can_redo():
-            last_redo,self.redos=self.redos[-1],self.redos[:-1]
-            last_redo.redo(self)
-            self.undos.append(last_redo)
+            node=self._current.redo_child
+            node.action.redo(self)
+            self._path.append(node)
+            self._move_to(node)
+    
+    def jump_to(self, node):
+        '''
+        go to any point in the undo history, including ones on branches
+        that were undone before making another edit
+        '''
+        if node.discarded:
+            raise ValueError("undo no longer available")
+        route=self._route(self._current, node, self.CHECKPOINT_INTERVAL)
+        if route is None:
+            # too far to undo and redo our way there, so start from the
+            # nearest copy of the document before it instead
+            checkpoint=node
+            while checkpoint.checkpoint is None and checkpoint.parent is not None:
+                checkpoint=checkpoint.parent
+            if checkpoint.checkpoint is not None:
+                checkpoint.checkpoint.restore(self)
+                route=self._route(checkpoint, node)
+            else:
+                route=self._route(self._current, node)
+        undos, redos=route
+        for undo in undos:
+            undo.action.undo(self)
+            undo.parent.redo_child=undo
+        for redo in redos:
+            redo.action.redo(self)
+            redo.parent.redo_child=redo
+        path=[]
+        while node is not None:
+            path.append(node)
+            node=node.parent
+        path.reverse()
+        self._path=deque(path)
+        self._move_to(path[-1])
+    
+    def undo_node_at(self, when):
+        '''the point in the undo history the document was at the given time'''
+        timeline=self._timeline
+        lo, hi=0, len(timeline)
+        while lo < hi:
+            mid=(lo+hi)//2
+            if timeline[mid][0] <= when:
+                lo=mid+1
+            else:
+                hi=mid
+        # anything from before the oldest undo still kept can only
+        # go back as far as that
+        for i in range(lo-1, -1, -1):
+            node=timeline[i][1]
+            if not node.discarded:
+                return node
+        return self._root
+    
+    def jump_to_time(self, when):
+        '''put the document back the way it was at the given time'''
+        self.jump_to(self.undo_node_at(when))
+    
+    def _route(self, start, end, limit=None):
+        '''
+        the nodes to undo and then redo to get from start to end, or None
+        if that takes more than limit steps
+        '''
+        undos=[]
+        redos=[]
+        while start is not end:
+            if limit is not None and len(undos)+len(redos) >= limit:
+                return None
+            if start.depth >= end.depth:
+                undos.append(start)
+                start=start.parent
+            else:
+                redos.append(end)
+                end=end.parent
+        redos.reverse()
+        return undos, redos
+    
+    def _move_to(self, node):
+        self._current=node
+        self._timeline.append((self.clock(), node))
+        self._can_coalesce=False
+    
+    def _push_undo(self, undo_action):
+        current=self._current
+        # nodes with a checkpoint are never added to, or it'd go out of date
+        if (self._can_coalesce and current.action is not None and
+                current.checkpoint is None and not current.children and
+                current.action.coalesce(undo_action, self.COALESCE_TIMEOUT)):
+            self._undo_size += undo_action.size-UNDO_OVERHEAD
+        else:
+            # any redos are kept as another branch of the history
+            node=UndoNode(current, undo_action, undo_action.time)
+            current.children.append(node)
+            current.redo_child=node
+            self._path.append(node)
+            self._move_to(node)
+            self._undo_count += 1
+            self._undo_size += undo_action.size
+            if node.depth % self.CHECKPOINT_INTERVAL == 0:
+                node.checkpoint=Checkpoint(self)
+                self._undo_size += node.checkpoint.size
+        self._can_coalesce=True
+        self._trim_undos()
+    
+    def _trim_undos(self):
+        # always keep the latest, so it can be undone however big it is
+        while len(self._path) > 2 and (self._undo_count > self.MAX_UNDOS or
+                                       self._undo_size > self.MAX_UNDO_SIZE):
+            root=self._path.popleft()
+            new_root=self._path[0]
+            root.discarded=True
+            for child in root.children:
+                if child is not new_root:
+                    self._discard(child)
+            self._undo_count -= 1
+            if new_root.checkpoint is None and root.checkpoint is not None:
+                # the root always needs a copy of the document to go back to,
+                # so keep the old one along with the action that follows it
+                new_root.checkpoint=RedoCheckpoint(root.checkpoint, new_root.action)
+            else:
+                if root.checkpoint is not None:
+                    self._undo_size -= root.checkpoint.size
+                self._undo_size -= new_root.action.size
+            new_root.parent=None
+            new_root.action=None
+            self._root=new_root
+        # forget times from before the oldest undo still kept
+        timeline=self._timeline
+        i=0
+        while i < len(timeline)-1 and timeline[i][1].discarded:
+            i += 1
+        if i:
+            del timeline[:i]
+    
+    def _discard(self, node):
+        '''throw away a branch of the undo history'''
+        nodes=[node]
+        while nodes:
+            node=nodes.pop()
+            node.discarded=True
+            self._undo_count -= 1
+            self._undo_size -= node.action.size
+            if node.checkpoint is not None:
+                self._undo_size -= node.checkpoint.size
+            nodes.extend(node.children)
     
     @undoable('Search')
-    def search(self, q):
-        super(UndoableDocument,self).search(q)
+    def search(self, q, job=None):
+        super(UndoableDocument,self).search(q, job)
     
     @undoable('Insert')
     def insert(self, offset, text):
@@ -237,6 +1149,10 @@ class UndoableDocument(Document):
     def remove(self, offset, length):
         super(UndoableDocument,self).remove(offset,length)
     
+    @undoable('Edit')
+    def apply_edits(self, edits):
+        super(UndoableDocument,self).apply_edits(edits)
+    
     def _insert_text(self, offset, text):
         if self.current_undo:
             self.current_undo.append(UndoInsert(self, offset, text))
@@ -246,30 +1162,117 @@ class UndoableDocument(Document):
         if self.current_undo:
             self.current_undo.append(UndoRemove(self, offset, length))
         super(UndoableDocument,self)._remove_text(offset, length)
+    
+    def _set_visible(self, visible):
+        if self.current_undo:
+            self.current_undo.append(UndoSetVisible(self, visible))
+        super(UndoableDocument,self)._set_visible(visible)
+    
+    def _resize_visible(self, i, delta):
+        if self.current_undo:
+            self.current_undo.append(UndoResizeVisible(self, i, delta))
+        super(UndoableDocument,self)._resize_visible(i, delta)
+    
+    def _shift_visible(self, i, delta):
+        if self.current_undo:
+            self.current_undo.append(UndoShiftVisible(self, i, delta))
+        super(UndoableDocument,self)._shift_visible(i, delta)
+    
+    def _delete_visible(self, spans):
+        if self.current_undo:
+            self.current_undo.append(UndoDeleteVisible(self, spans))
+        super(UndoableDocument,self)._delete_visible(spans)
+
+
+# rough number of bytes of memory used by each recorded action
+UNDO_OVERHEAD=64
+
+class UndoNode(object):
+    '''
+    a point in the undo history, reached from its parent by redoing
+    its action.  there's a child for each edit made after undoing back
+    to this point, and redo goes to the one visited most recently.
+    '''
+    
+    def __init__(self, parent, action, time):
+        self.parent=parent
+        self.action=action
+        self.time=time
+        self.children=[]
+        self.redo_child=None
+        self.depth=parent.depth+1 if parent is not None else 0
+        # a copy of the document as of this point, every so often
+        self.checkpoint=None
+        # set once this point has been thrown away to save memory
+        self.discarded=False
+    
+    def __repr__(self):
+        return 'UndoNode(%r)' % self.action
+
+class Checkpoint(object):
+    # a copy of a document's state to go back to.  the rope's chunks
+    # never change, so the copy of the text only costs the list of chunks
+    
+    def __init__(self, doc):
+        self.rope=doc._rope.snapshot()
+        self.visible=copy(doc._visible)
+        self.current_search=doc.current_search
+        self.current_offset=doc.current_offset
+        self.size=UNDO_OVERHEAD*(1+len(self.visible))+16*self.rope.chunk_count
+    
+    def restore(self, doc):
+        if doc._journal is not None:
+            # just the text that differs, rather than the whole document
+            for offset, length, text in doc._rope.changes(self.rope):
+                if length:
+                    doc._journal.remove(offset, length)
+                if text:
+                    doc._journal.insert(offset, text)
+        doc._rope.restore(self.rope)
+        doc._version += 1
+        doc._search_stack=[]
+        doc._visible=copy(self.visible)
+        doc.current_search=self.current_search
+        doc.current_offset=self.current_offset
 
+class RedoCheckpoint(object):
+    # the state after redoing an action from an earlier checkpoint
+    
+    def __init__(self, checkpoint, action):
+        self.checkpoint=checkpoint
+        self.action=action
+        self.size=checkpoint.size+action.size
+    
+    def restore(self, doc):
+        self.checkpoint.restore(doc)
+        self.action.redo(doc)
 
 class UndoAction(object):
-    def __init__(self, doc, description):
+    # changes to the visible sections are recorded as actions alongside the
+    # changes to the text, so they are undone and redone in the same order
+    
+    def __init__(self, doc, description, args=()):
         self.description=description
-        self.visible=[copy(v) for v in doc._visible]
+        # only kept for coalescing typing, as the arguments of anything else
+        # (like a search job and its snapshot) can be big and aren't counted
+        self.args=args if description in ('Insert', 'Remove') else None
+        self.time=doc.clock()
         self.current_search=doc.current_search
         self.current_offset=doc.current_offset
         self.actions=[]
+        self.size=UNDO_OVERHEAD
     
     def update_redo(self, doc):
-        self.redo_visible=[copy(v) for v in doc._visible]
         self.redo_current_search=doc.current_search
         self.redo_current_offset=doc.current_offset
     
     def undo(self, doc):
-        doc._visible=self.visible
         doc.current_search=self.current_search
         doc.current_offset=self.current_offset
         for action in reversed(self.actions):
             action.undo(doc)
     
     def redo(self, doc):
-        doc._visible=self.redo_visible
         doc.current_search=self.redo_current_search
         doc.current_offset=self.redo_current_offset
         for action in self.actions:
@@ -277,6 +1280,38 @@ class UndoAction(object):
     
     def append(self, action):
         self.actions.append(action)
+        self.size += action.size
+    
+    def coalesce(self, other, timeout):
+        '''
+        fold the following undo action into this one, if they are both
+        single characters typed (or deleted) one after the other
+        '''
+        if other.description != self.description or other.time-self.time >= timeout:
+            return False
+        if self.description == 'Insert':
+            offset, text=self.args
+            other_offset, other_text=other.args
+            if len(text) != 1 or len(other_text) != 1 or other_offset != offset+1:
+                return False
+            # start a new undo at the start of each word
+            if text.isspace() and not other_text.isspace():
+                return False
+        elif self.description == 'Remove':
+            offset, length=self.args
+            other_offset, other_length=other.args
+            # either backspacing or deleting forwards
+            if length != 1 or other_length != 1 or other_offset not in (offset-1, offset):
+                return False
+        else:
+            return False
+        self.actions.extend(other.actions)
+        self.size += other.size-UNDO_OVERHEAD
+        self.args=other.args
+        self.time=other.time
+        self.redo_current_search=other.redo_current_search
+        self.redo_current_offset=other.redo_current_offset
+        return True
     
     def __repr__(self):
         return 'UndoAction(%s)' % self.description
@@ -286,6 +1321,7 @@ class UndoInsert(object):
     def __init__(self, doc, offset, text):
         self.offset=offset
         self.text=text
+        self.size=UNDO_OVERHEAD+len(text)
     
     def undo(self, doc):
         doc._remove_text(self.offset,len(self.text))
@@ -297,7 +1333,8 @@ class UndoRemove(object):
 
     def __init__(self, doc, offset, length):
         self.offset=offset
-        self.text=doc.text[offset:offset+length]
+        self.text=doc._rope[offset:offset+length]
+        self.size=UNDO_OVERHEAD+length
 
     def undo(self, doc):
         doc._insert_text(self.offset,self.text)
@@ -305,6 +1342,59 @@ class UndoRemove(object):
     def redo(self, doc):
         doc._remove_text(self.offset,len(self.text))
 
+class UndoSetVisible(object):
+    # the document is only ever given copies of the sections, as jumping
+    # to a checkpoint doesn't undo the changes made to the ones in use
+    
+    def __init__(self, doc, visible):
+        self.visible=copy(visible)
+        self.previous_visible=doc._visible
+        self.size=UNDO_OVERHEAD*(1+len(visible))
+    
+    def undo(self, doc):
+        doc._set_visible(copy(self.previous_visible))
+    
+    def redo(self, doc):
+        doc._set_visible(copy(self.visible))
 
+class UndoResizeVisible(object):
+    size=UNDO_OVERHEAD
+    
+    def __init__(self, doc, i, delta):
+        self.i=i
+        self.delta=delta
+    
+    def undo(self, doc):
+        doc._resize_visible(self.i,-self.delta)
+    
+    def redo(self, doc):
+        doc._resize_visible(self.i,self.delta)
 
-            
\ No newline at end of file
+class UndoShiftVisible(object):
+    size=UNDO_OVERHEAD
+    
+    def __init__(self, doc, i, delta):
+        self.i=i
+        self.delta=delta
+    
+    def undo(self, doc):
+        doc._shift_visible(self.i,-self.delta)
+    
+    def redo(self, doc):
+        doc._shift_visible(self.i,self.delta)
+
+class UndoDeleteVisible(object):
+    
+    def __init__(self, doc, spans):
+        self.spans=spans
+        # put back in order, each span's start is where it was
+        self.sections=[(start, [(doc._visible.offset(i), doc._visible.length(i))
+                                    for i in range(start, stop)])
+                            for start, stop in spans]
+        self.size=UNDO_OVERHEAD*(1+sum(stop-start for start, stop in spans))
+    
+    def undo(self, doc):
+        doc._insert_visible(self.sections)
+    
+    def redo(self, doc):
+        doc._delete_visible(self.spans)
@@ -3,8 +3,9 @@ import wx.stc
 
 import sys
 
-from model import UndoableDocument
+from model import UndoableDocument, apply_visible_changes
 from events import Event
+from background import SearchScheduler
 from wxdoc import Preferences, DocumentFrame, check_for_modification
 
 PREF_SHOW_LINENUMBERS='SHOW_LINENUMBERS'
@@ -54,7 +55,6 @@ class PrefDialog(wx.Dialog):
         
         def update_pref(event):
             self.prefs.set(pref_key, checkbox.GetValue())
-            self.prefs.flush()
         
         checkbox.Bind(wx.EVT_CHECKBOX, update_pref)
         return checkbox
@@ -108,60 +108,74 @@ class NoteCombFrame(DocumentFrame):
         self.panel.SetSizer(sizer)
         self.Layout()
         
+        self.search_scheduler=SearchScheduler(self.doc, self.SearchFinished, post=wx.CallAfter)
+        
+        self.refresher.add('line_numbers', self._line_number_inputs, self._update_line_numbers)
+        self.refresher.add('colours', lambda: self.doc.current_search != '', self._update_colours)
+        
         self.UpdateFromDoc()
         
         self.prefs.changed += self.prefs_changed
         self.set_show_linenumbers(self.prefs.get(PREF_SHOW_LINENUMBERS,True))
         
-        self.timer=wx.Timer(self,-1)
-        self.Bind(wx.EVT_TIMER, self.OnTimer, self.timer)
-        self.timer.Start(5*60*1000)
+        wx.GetApp().save_scheduler.add(self.doc, self.AutoSaved,
+                                       lambda: self.prefs.get(PREF_AUTO_SAVE,True))
     
-    def prefs_changed(self, key, value):
-        if key == PREF_SHOW_LINENUMBERS:
-            self.set_show_linenumbers(value)
-        elif key == PREF_RECENT_FILES:
+    def prefs_changed(self, changes):
+        # only the latest value of each pref matters
+        changes=dict(changes)
+        if PREF_SHOW_LINENUMBERS in changes:
+            self.set_show_linenumbers(changes[PREF_SHOW_LINENUMBERS])
+        if PREF_RECENT_FILES in changes:
             self.update_recent_files_menu()
     
     def set_show_linenumbers(self, value):
-        if value:
-            num_lines=self.text.GetLineCount()
-            width=self.text.TextWidth(wx.stc.STC_STYLE_DEFAULT,'%03d'%num_lines)
+        self._show_line_numbers=value
+        self.refresher.invalidate('line_numbers')
+    
+    def _line_number_inputs(self):
+        if not self._show_line_numbers:
+            return 0
+        # the margin only needs resizing when there's another digit
+        return len('%03d' % self.text.GetLineCount())
+    
+    def _update_line_numbers(self, digits):
+        if digits:
+            width=self.text.TextWidth(wx.stc.STC_STYLE_DEFAULT,'9'*digits)
             self.text.SetMarginWidth(0,width+5)
         else:
             self.text.SetMarginWidth(0,0)
-        self._show_line_numbers=value
     
     @check_for_modification
     def OnClose(self,event):
         self.SaveDefaultSizeAndPosition()
-        self.timer.Stop()
+        # stop listening now, rather than when the frame is collected, so
+        # any changes that are still waiting don't go to a destroyed window
+        self.prefs.changed -= self.prefs_changed
+        wx.GetApp().save_scheduler.remove(self.doc)
+        self.search_scheduler.cancel()
+        self.doc.close()
         self.Destroy()
     
-    def OnTimer(self, event):
-        if self.prefs.get(PREF_AUTO_SAVE,True):
-            if self.doc.is_modified:
-                self.doc.save()
-                self.UpdateMenus()
+    def AutoSaved(self, doc, error):
+        # the frame may have been closed while saving
+        if not self:
+            return
+        if error is not None:
+            wx.LogError("Could not auto-save %s: %s" % (doc.filename, error))
+        self.UpdateMenus()
     
     def TextSetFocus(self,event):
         self.UpdateMenus()
         event.Skip()
     
-    def UpdateMenus(self):
-        super(NoteCombFrame,self).UpdateMenus()
-        
-        # check we've initialised fully
-        if not getattr(self, 'text', None):
-            return
-        self.set_show_linenumbers(self._show_line_numbers)
-    
     def UpdateFromDoc(self):
         super(NoteCombFrame,self).UpdateFromDoc()
+        # the document has moved on, so any search in progress is out of date
+        self.search_scheduler.cancel()
         q=self.doc.current_search
         self.search.ChangeValue(q)
         self.search.ShowCancelButton(q != '') 
-        self._update_colours()
         self._update_visible_text()
         self.UpdateMenus()
     
@@ -181,8 +195,8 @@ class NoteCombFrame(DocumentFrame):
         self.text.StyleSetBackground(style,'#FFFF99')
         self.text.SetCaretLineBackground('#EEEE99')
     
-    def _update_colours(self):
-        if self.doc.current_search:
+    def _update_colours(self, searching):
+        if searching:
             self.SetSearchColours()
         else:
             self.SetRegularColours()
@@ -193,9 +207,13 @@ class NoteCombFrame(DocumentFrame):
     def Search(self,event):
         q=self.search.GetValue()
         self.search.ShowCancelButton(q != '') 
-        self.doc.search(q)
-        self._update_colours()
-        self._update_visible_text()
+        self.search_scheduler.schedule(q)
+    
+    def SearchFinished(self, job):
+        previous=self.doc.visible_sections
+        self.doc.search(job.q, job)
+        self.refresher.invalidate('colours')
+        self._update_visible_text(self.doc.visible_changes(previous))
     
     def OnCopy(self, event):
         if self.text.GetSelectedText():
@@ -216,12 +234,19 @@ class NoteCombFrame(DocumentFrame):
         self.search.SetFocus()
         self.search.SelectAll()
     
-    def _update_visible_text(self):
+    def _update_visible_text(self, changes=None):
         # disable modification events while we
         # update the text in the text area
         mod_mask=self.text.GetModEventMask()
         self.text.SetModEventMask(0)
-        self.text.SetText(self.doc.visible_text)
+        if changes is None:
+            self.text.ClearAll()
+            for chunk in self.doc.view.chunks():
+                self.text.AppendText(chunk)
+        else:
+            # only touch the parts of the text that have changed, so
+            # the control doesn't have to lay everything out again
+            apply_visible_changes(self.text, changes)
         self.text.GotoPos(self.doc.current_offset)
         self.text.SetModEventMask(mod_mask)
     
@@ -237,7 +262,8 @@ class NoteCombFrame(DocumentFrame):
         if action:
             action(event)
         
-        self.UpdateMenus()
+        # the colours can't change from typing
+        self.refresher.invalidate('title', 'menus', 'line_numbers')
     
     def ModifiedInsertText(self, event):
         offset=event.GetPosition()
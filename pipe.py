@@ -1,18 +1,56 @@
+import errno
+import getpass
+import json
 import tempfile
 import os, os.path
+import stat
 import time
 import mmap
+import socket
 import sys
+import threading
 try:
-    import cPickle as pickle
+    import queue
 except ImportError:
-    import pickle
+    import Queue as queue
 
 '''
-this is based on the code from pydocview, but packaged up into
-a class that doesn't depend on wx
+passing data (such as filenames to open) from one instance of an app to
+another that's already running, without depending on wx.
+
+where there are unix domain sockets the running instance listens on one,
+and gets each message as soon as it's sent.  otherwise it falls back to a
+shared memory file that has to be polled (based on the code from
+pydocview).
+
+messages are sent as json rather than pickled, so whoever is at the other
+end can only ever send plain data.
 '''
 
+def call_now(fn, *args):
+    fn(*args)
+
+def pipe_name(app_name):
+    '''the name of the pipe for an app, one per user'''
+    return '%s-%s' % (app_name, getpass.getuser())
+
+def forward(name, data):
+    '''
+    send data to an instance that's already running and listening on the
+    named pipe, returning False straight away if there isn't one.  raises
+    socket.timeout if there is one but it doesn't answer.  it only needs
+    the standard library, so can be tried before loading anything else.
+    '''
+    if Pipe is not SocketPipe:
+        return False
+    try:
+        Pipe(name).write(data, timeout=0)
+    except socket.timeout:
+        raise
+    except socket.error:
+        return False
+    return True
+
 def open_shared_mem(name):
     if sys.platform == 'win32':
         tfile = tempfile.TemporaryFile(prefix=name,suffix="tmp")
@@ -28,13 +66,28 @@ def open_shared_mem(name):
         fno = tfile.fileno()
         return mmap.mmap(fno, 1024)
 
-class Pipe(object):
+class MappedPipe(object):
     def __init__(self, name):
         self._sharedMemory = open_shared_mem(name)
     
+    def listen(self, callback, post=call_now):
+        '''check for data every second, passing any to callback'''
+        def _poll():
+            while True:
+                data=self.read()
+                if data is not None:
+                    post(callback, data)
+                time.sleep(1)
+        thread=threading.Thread(target=_poll)
+        thread.daemon=True
+        thread.start()
+    
+    def close(self):
+        pass
+    
     def write(self, data):
         '''write into shared memory, once we are able to'''
-        data = pickle.dumps(data)
+        data = json.dumps(data)
         while True:
             self._sharedMemory.seek(0)
             marker = self._sharedMemory.read_byte()
@@ -58,5 +111,144 @@ class Pipe(object):
             self._sharedMemory.write_byte("*")
             self._sharedMemory.flush()
             
-            return pickle.loads(data)
-        return None
\ No newline at end of file
+            # anything after the message is left over from earlier ones
+            return json.JSONDecoder().raw_decode(data)[0]
+        return None
+
+def _check_private(path):
+    '''make sure only this user can get into the directory at path'''
+    try:
+        st=os.lstat(path)
+    except OSError as e:
+        raise socket.error(e.errno, e.strerror)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise socket.error('%s is not a private directory' % path)
+
+class SocketPipe(object):
+    # how long write waits for the other instance to start listening
+    CONNECT_TIMEOUT=5.0
+    # how long either end waits for the other once they're connected
+    READ_TIMEOUT=5.0
+    
+    def __init__(self, name):
+        # anyone can make things in the temp dir, so the socket goes in a
+        # directory of our own, which is checked before it's used
+        base=os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+        self.dir=os.path.join(base, name)
+        self.path=os.path.join(self.dir, 'pipe.sock')
+        self._socket=None
+        self._received=queue.Queue()
+    
+    def write(self, data, timeout=None):
+        '''
+        send data to the instance that's listening, waiting up to timeout
+        seconds (CONNECT_TIMEOUT by default) for it to start.  raises
+        socket.timeout if it's there but doesn't take the data in time
+        '''
+        data = json.dumps(data).encode('utf-8')
+        if timeout is None:
+            timeout=self.CONNECT_TIMEOUT
+        deadline=time.time()+timeout
+        while True:
+            sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            # so an instance that's stuck can't hold us up for ever
+            sock.settimeout(self.READ_TIMEOUT)
+            try:
+                try:
+                    _check_private(self.dir)
+                    sock.connect(self.path)
+                except socket.error:
+                    # it may still be starting up
+                    if time.time() >= deadline:
+                        raise
+                    time.sleep(0.05)
+                    continue
+                sock.sendall(data)
+                sock.shutdown(socket.SHUT_WR)
+                # wait for the other end to finish reading
+                if not sock.recv(1):
+                    raise socket.error('the data was not received')
+                return
+            finally:
+                sock.close()
+    
+    def read(self):
+        '''the next data received while listening without a callback, or None'''
+        try:
+            return self._received.get_nowait()
+        except queue.Empty:
+            return None
+    
+    def listen(self, callback=None, post=call_now):
+        '''
+        start listening for data on a background thread.  each time some
+        arrives it's passed to callback (through post), or kept for read()
+        '''
+        try:
+            os.mkdir(self.dir, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        _check_private(self.dir)
+        try:
+            if stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                # left behind by an instance that didn't shut down cleanly
+                os.remove(self.path)
+        except OSError:
+            pass
+        sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(5)
+        self._socket=sock
+        thread=threading.Thread(target=self._accept, args=(sock, callback, post))
+        thread.daemon=True
+        thread.start()
+    
+    def _accept(self, sock, callback, post):
+        while True:
+            try:
+                conn, address=sock.accept()
+            except socket.error:
+                # closed
+                return
+            try:
+                # don't let a writer that stops sending hold up the rest
+                conn.settimeout(self.READ_TIMEOUT)
+                try:
+                    chunks=[]
+                    while True:
+                        chunk=conn.recv(65536)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                    data=json.loads(b''.join(chunks).decode('utf-8'))
+                except Exception:
+                    continue
+                if callback is None:
+                    self._received.put(data)
+                else:
+                    post(callback, data)
+                # let the writer know it's been received
+                conn.sendall(b'+')
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+    
+    def close(self):
+        '''stop listening'''
+        if self._socket is not None:
+            # wakes up the thread waiting in accept
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._socket.close()
+            self._socket=None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+if hasattr(socket, 'AF_UNIX'):
+    Pipe=SocketPipe
+else:
+    Pipe=MappedPipe
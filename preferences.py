@@ -0,0 +1,125 @@
+import os
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from events import Event
+
+'''
+preferences kept in memory and written out in batches.
+
+values are read from the store the first time they're asked for and
+then kept, already unpickled.  setting a value just changes the copy in
+memory and marks it as needing writing; the changed values are written
+to the store together the next time flush() is called (which the app
+does every few seconds, and on exit), so ticking a box or moving a
+window doesn't go to disk each time.
+
+a store has read(key), returning the pickled value or None, and
+write(items) to save a list of (key, pickled value) at once.  the wx app
+uses one that wraps wx.ConfigBase, and FileStore keeps them in a file.
+'''
+
+def _encode(value):
+    # protocol 0 is plain text, so it can be stored as a string anywhere
+    data=pickle.dumps(value, 0)
+    if str is bytes:
+        return data
+    return data.decode('latin-1')
+
+def _decode(data):
+    # wx.Config gives back unicode, even on python 2
+    if not isinstance(data, bytes):
+        data=data.encode('latin-1')
+    return pickle.loads(data)
+
+class FileStore(object):
+    '''keeps preferences in a file of their own'''
+
+    def __init__(self, filename):
+        self.filename=filename
+        try:
+            file=open(filename, 'rb')
+        except IOError:
+            self._values={}
+        else:
+            try:
+                self._values=pickle.load(file)
+            finally:
+                file.close()
+
+    def read(self, key):
+        return self._values.get(key)
+
+    def write(self, items):
+        self._values.update(items)
+        # write to a new file and move it into place, so there's always
+        # a whole copy of the preferences on disk
+        fd, temp_path=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)))
+        try:
+            file=os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(self._values, file, 2)
+            finally:
+                file.close()
+            if hasattr(os, 'replace'):
+                os.replace(temp_path, self.filename)
+            else:
+                if os.path.exists(self.filename):
+                    os.remove(self.filename)
+                os.rename(temp_path, self.filename)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+_missing=object()
+
+class Preferences(object):
+    '''
+    preferences read from and written to a store.  values returned by
+    get() are shared with the cache, so should be replaced with set()
+    rather than changed in place.  changed is called with (key, value)
+    for each value set, or batched if post is given (see events.Event).
+    '''
+
+    def __init__(self, store, post=None):
+        self.store=store
+        self.changed=Event(post)
+        # unpickled values, or _missing for keys the store doesn't have
+        self._values={}
+        self._dirty=set()
+
+    def get(self, key, defaultValue):
+        try:
+            value=self._values[key]
+        except KeyError:
+            value=self._read(key)
+            self._values[key]=value
+        if value is _missing:
+            return defaultValue
+        return value
+
+    def _read(self, key):
+        data=self.store.read(key)
+        if not data:
+            return _missing
+        try:
+            return _decode(data)
+        except Exception:
+            return _missing
+
+    def set(self, key, value):
+        self._values[key]=value
+        self._dirty.add(key)
+        self.changed(key, value)
+
+    def flush(self):
+        '''write all the changed values to the store now'''
+        if not self._dirty:
+            return
+        items=[(key, _encode(self._values[key])) for key in sorted(self._dirty)]
+        self.store.write(items)
+        self._dirty=set()
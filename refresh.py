@@ -0,0 +1,54 @@
+from background import call_now
+
+'''
+keeps the parts of a window that show the state of the document (the
+title, which menu items are enabled and so on) up to date, without
+redoing them after every keystroke.
+
+each part has a function giving the inputs it's drawn from, and one to
+update it from them.  changes just mark parts as stale, and they're all
+brought up to date together the next time the gui is idle, and only if
+their inputs are different from the last time they were updated.
+'''
+
+class Refresher(object):
+
+    def __init__(self, post=call_now):
+        self.post=post
+        # name -> (inputs, update)
+        self._parts={}
+        self._order=[]
+        # the inputs each part was last updated from
+        self._current={}
+        self._stale=set()
+        self._posted=False
+
+    def add(self, name, inputs, update):
+        '''
+        add a part to keep up to date.  inputs() gives a value to compare
+        with last time, and update(value) is called when it changes
+        '''
+        self._parts[name]=(inputs, update)
+        self._order.append(name)
+        self.invalidate(name)
+
+    def invalidate(self, *names):
+        '''mark parts (or all of them) as needing checking'''
+        self._stale.update(names or self._order)
+        if not self._posted:
+            self._posted=True
+            self.post(self.refresh)
+
+    def refresh(self):
+        '''update any stale parts whose inputs have changed'''
+        self._posted=False
+        stale, self._stale=self._stale, set()
+        for name in self._order:
+            if name not in stale:
+                continue
+            inputs, update=self._parts[name]
+            value=inputs()
+            if name in self._current and self._current[name] == value:
+                continue
+            self._current[name]=value
+            update(value)
@@ -0,0 +1,364 @@
+from array import array
+import codecs
+from copy import copy
+import locale
+
+from fenwick import Fenwick
+
+'''
+a rope for holding large amounts of text that is edited in place.
+
+the text is stored as a list of chunks, each holding one or more whole
+lines, with a Fenwick tree over the chunk lengths so that finding the
+chunk for an offset is O(log n).  inserting or removing text only
+rebuilds the chunks involved.
+'''
+
+def line_starts(text):
+    '''offsets of the start of each line in text'''
+    starts=[0]
+    length=len(text)
+    i=text.find('\n')
+    while i != -1 and i+1 < length:
+        starts.append(i+1)
+        i=text.find('\n', i+1)
+    return array('l', starts)
+
+class Chunk(object):
+    '''
+    a piece of the text holding whole lines, along with an index of
+    where each line starts (built the first time it is needed)
+    '''
+    __slots__=('text','_line_starts')
+    
+    def __init__(self, text):
+        self.text=text
+        self._line_starts=None
+    
+    def __len__(self):
+        return len(self.text)
+    
+    @property
+    def line_starts(self):
+        '''offsets of the start of each line in the chunk'''
+        if self._line_starts is None:
+            self._line_starts=line_starts(self.text)
+        return self._line_starts
+
+_UTF8_CONTINUATION=bytes(bytearray(range(0x80, 0xc0)))
+
+if hasattr(bytes, 'isascii'):
+    def _is_ascii(data):
+        return data.isascii()
+else:
+    def _is_ascii(data):
+        return False
+
+class MappedFile(object):
+    '''
+    a memory mapped file along with how to turn its bytes into text
+    (the same way as reading it in text mode with universal newlines)
+    '''
+    
+    def __init__(self, mapping, encoding=None):
+        self.mapping=mapping
+        if encoding is None and str is not bytes:
+            encoding=locale.getpreferredencoding(False)
+        self.encoding=encoding
+        self._codec=codecs.lookup(encoding).name if encoding is not None else None
+    
+    def __len__(self):
+        return len(self.mapping)
+    
+    def length(self, start, end):
+        '''
+        the length of text(start, end), counted from the bytes without
+        decoding them for the usual encodings
+        '''
+        data=self.mapping[start:end]
+        if self._codec in (None, 'ascii', 'iso8859-1'):
+            length=len(data)
+        elif self._codec == 'utf-8':
+            # every character has one byte that isn't a continuation byte
+            if _is_ascii(data):
+                length=len(data)
+            else:
+                length=len(data.translate(None, _UTF8_CONTINUATION))
+        else:
+            return len(self.text(start, end))
+        if b'\r' in data:
+            length -= data.count(b'\r\n')
+        return length
+    
+    def text(self, start, end):
+        text=self.mapping[start:end]
+        if self.encoding is not None:
+            text=text.decode(self.encoding)
+        if '\r' in text:
+            text=text.replace('\r\n', '\n').replace('\r', '\n')
+        return text
+
+class MappedChunk(Chunk):
+    '''
+    a chunk that is still the same as part of a memory mapped file, and
+    reads its text from there each time it's needed rather than holding
+    on to it
+    '''
+    __slots__=('_file','_start','_end','_length')
+    
+    def __init__(self, file, start, end):
+        self._file=file
+        self._start=start
+        self._end=end
+        self._line_starts=None
+        self._length=file.length(start, end)
+    
+    def __len__(self):
+        return self._length
+    
+    @property
+    def text(self):
+        return self._file.text(self._start, self._end)
+
+class Rope(object):
+    CHUNK_SIZE=4096
+
+    def __init__(self, text='', index=None):
+        self._set_chunks(self._split(text), index)
+    
+    @classmethod
+    def mapped(cls, file, index=None):
+        '''
+        a rope over the text of a MappedFile.  the file is read through
+        once to split it into chunks, but only the chunks that are edited
+        are held in memory.
+        '''
+        rope=cls.__new__(cls)
+        rope._set_chunks(rope._split_mapped(file), index)
+        return rope
+    
+    def _set_chunks(self, chunks, index):
+        self._chunks=chunks
+        self._lengths=Fenwick(len(chunk) for chunk in self._chunks)
+        self._positions=dict((chunk, i) for i, chunk in enumerate(self._chunks))
+        # optional index (such as a WordIndex) kept up to date with the chunks
+        self.index=index
+        if index is not None:
+            index.update((), self._chunks)
+
+    def __len__(self):
+        return self._lengths.total()
+
+    def snapshot(self):
+        '''
+        a copy of the rope that shares its chunks (which never change),
+        to read from while this one carries on being edited
+        '''
+        rope=type(self).__new__(type(self))
+        rope._chunks=list(self._chunks)
+        rope._lengths=copy(self._lengths)
+        rope._positions=dict(self._positions)
+        rope.index=None
+        return rope
+
+    def restore(self, other):
+        '''make this rope hold the same text as another (eg a snapshot of it)'''
+        if self.index is not None:
+            chunks=set(self._chunks)
+            other_chunks=set(other._chunks)
+            self.index.update(chunks-other_chunks, other_chunks-chunks)
+        self._chunks=list(other._chunks)
+        self._lengths=copy(other._lengths)
+        self._positions=dict(other._positions)
+
+    def changes(self, other):
+        '''
+        (offset, length, text) for each piece of text to remove and insert
+        to turn this rope's text into another's, with each offset into the
+        text as it is after the changes before.  the ropes are compared by
+        the chunks they share, so only the text of the rest is looked at
+        '''
+        positions=other._positions
+        changes=[]
+        offset=0
+        removed=0
+        j=0
+        for chunk in self._chunks:
+            k=positions.get(chunk)
+            if k is None or k < j:
+                removed += len(chunk)
+                continue
+            if removed or k > j:
+                text=''.join(inserted.text for inserted in other._chunks[j:k])
+                changes.append((offset, removed, text))
+                offset += len(text)
+                removed=0
+            offset += len(chunk)
+            j=k+1
+        if removed or j < len(other._chunks):
+            changes.append((offset, removed, ''.join(inserted.text for inserted in other._chunks[j:])))
+        return changes
+
+    @property
+    def chunk_count(self):
+        return len(self._chunks)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step=index.indices(len(self))
+            if step != 1:
+                raise ValueError("rope slices do not support steps")
+            return ''.join(self.chunks(start, stop))
+        length=len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("rope index out of range")
+        return self[index:index+1]
+
+    def chunks(self, start=0, end=None):
+        '''iterate over the text between start and end a chunk at a time'''
+        if end is None:
+            end=len(self)
+        for chunk_start, chunk in self.iter_chunks(start, end):
+            text=chunk.text
+            chunk_end=chunk_start+len(text)
+            if start <= chunk_start and chunk_end <= end:
+                yield text
+            else:
+                yield text[max(start-chunk_start, 0):end-chunk_start]
+    
+    def iter_chunks(self, start=0, end=None):
+        '''iterate over (offset, chunk) for the chunks overlapping start to end'''
+        if end is None:
+            end=len(self)
+        if start >= end:
+            return
+        i=self._lengths.find(start)
+        chunk_start=self._lengths.prefix(i)
+        while chunk_start < end:
+            chunk=self._chunks[i]
+            yield chunk_start, chunk
+            chunk_start += len(chunk)
+            i += 1
+
+    def locate(self, chunks):
+        '''sorted (offset, chunk) for each of the given chunks'''
+        positions=sorted(self._positions[chunk] for chunk in chunks)
+        return [(self._lengths.prefix(i), self._chunks[i]) for i in positions]
+
+    def insert(self, offset, text):
+        if not text:
+            return
+        if not 0 <= offset <= len(self):
+            raise ValueError("invalid offset %d" % offset)
+        if not self._chunks:
+            self._replace(0, 0, text)
+            return
+        # an offset on a chunk boundary goes at the start of the
+        # following chunk, so the chunk keeps its trailing newline
+        i=min(self._lengths.find(offset), len(self._chunks)-1)
+        chunk_offset=offset-self._lengths.prefix(i)
+        chunk=self._chunks[i].text
+        self._replace(i, i+1, chunk[:chunk_offset]+text+chunk[chunk_offset:])
+
+    def remove(self, offset, length):
+        if length <= 0:
+            return
+        end=offset+length
+        if offset < 0 or end > len(self):
+            raise ValueError("invalid range %d-%d" % (offset, end))
+        first=self._lengths.find(offset)
+        last=self._lengths.find(end-1)
+        head=self._chunks[first].text[:offset-self._lengths.prefix(first)]
+        tail=self._chunks[last].text[end-self._lengths.prefix(last):]
+        text=head+tail
+        stop=last+1
+        # if we removed the newline at the end of a chunk its last
+        # line now carries on into the next chunk, so join them up
+        if text and not text.endswith('\n') and stop < len(self._chunks):
+            text += self._chunks[stop].text
+            stop += 1
+        self._replace(first, stop, text)
+
+    def _replace(self, start, stop, text):
+        '''replace the chunks from start to stop with the given text'''
+        chunks=self._split(text)
+        removed=self._chunks[start:stop]
+        if len(chunks) == 1 and stop-start == 1:
+            delta=len(chunks[0])-len(removed[0])
+            self._chunks[start]=chunks[0]
+            self._lengths.add(start, delta)
+            del self._positions[removed[0]]
+            self._positions[chunks[0]]=start
+        else:
+            self._chunks[start:stop]=chunks
+            self._lengths.rebuild(len(chunk) for chunk in self._chunks)
+            self._positions=dict((chunk, i) for i, chunk in enumerate(self._chunks))
+        if self.index is not None:
+            self.index.update(removed, chunks)
+
+    def _split_mapped(self, file):
+        '''
+        split a mapped file into chunks the same way as _split, going by
+        the number of bytes rather than characters
+        '''
+        chunks=[]
+        mapping=file.mapping
+        start=0
+        length=len(mapping)
+        half=self.CHUNK_SIZE//2
+        while length-start > self.CHUNK_SIZE:
+            end=self._find_line_end(mapping, start, start+half)
+            if end == -1:
+                break
+            chunks.append(MappedChunk(file, start, end))
+            start=end
+        if start < length:
+            chunks.append(MappedChunk(file, start, length))
+        return chunks
+    
+    def _find_line_end(self, mapping, start, middle):
+        '''
+        the end of the last line ending before middle (or the first one
+        after it), or -1 if there's no line ending before the end of the file
+        '''
+        length=len(mapping)
+        end=mapping.rfind(b'\n', start, middle)
+        if end == -1:
+            # could be a file with mac line endings
+            end=mapping.rfind(b'\r', start, middle-1)
+            if end == -1:
+                end=mapping.find(b'\n', middle)
+                if end == -1:
+                    end=mapping.find(b'\r', middle)
+                    if end != -1 and mapping[end+1:end+2] == b'\n':
+                        end += 1
+        end += 1
+        if end == 0 or end == length:
+            return -1
+        return end
+    
+    def _split(self, text):
+        '''
+        split text into chunks on line boundaries.  chunks that have grown
+        too large are split roughly in half so that they have room to grow
+        again before the next split.  a single line longer than the chunk
+        size is kept whole.
+        '''
+        chunks=[]
+        start=0
+        length=len(text)
+        half=self.CHUNK_SIZE//2
+        while length-start > self.CHUNK_SIZE:
+            end=text.rfind('\n', start, start+half)
+            if end == -1:
+                end=text.find('\n', start+half)
+                if end == -1 or end+1 == length:
+                    break
+            end += 1
+            chunks.append(Chunk(text[start:end]))
+            start=end
+        if start < length:
+            chunks.append(Chunk(text[start:]))
+        return chunks
@@ -0,0 +1,307 @@
+from bisect import bisect_right
+import locale
+import multiprocessing
+import optparse
+import os
+import re
+import sys
+
+from model import matching_lines, search_words
+from rope import line_starts
+
+'''
+search note files from the command line, without the gui:
+
+    python search.py [-n] [-b] [-m count] [-j jobs] "words to find" [file or directory ...]
+
+prints every line that has all of the words in it (ignoring case), the
+same as searching in NoteComb.  with no files (or a file of -) it reads
+from stdin.  files are read a block of lines at a time, so they can be
+as big as you like.  when there's more than one file they're searched in
+parallel, and the results from each file come out as it's finished.
+lines can end in \n, \r\n or \r, the same as in the gui.
+'''
+
+# roughly how much of a file to search at once
+BLOCK_SIZE=1024*1024
+# roughly how much of a file each process searches, when searching in parallel
+TASK_SIZE=16*1024*1024
+# lines longer than this are searched a piece at a time
+MAX_LINE_LENGTH=16*1024*1024
+
+_line_end=re.compile('\r\n|\r|\n')
+_line_end_bytes=re.compile(b'\r\n|\r|\n')
+
+def search_file(file, q, encoding=None):
+    '''
+    (line number, byte offset, line) for each line matching the search q,
+    in a file opened in binary mode.  line numbers start from 1.
+    '''
+    return _search(file, q, encoding)
+
+def _search(file, q, encoding=None, length=None, totals=None):
+    '''
+    search_file, stopping after length bytes (if given).  the number of
+    lines and bytes searched are added to totals at the end.
+    '''
+    if encoding is None:
+        encoding=locale.getpreferredencoding(False)
+    words=search_words(q)
+    line_number=1
+    offset=0
+    read=0
+    # the start of a line that carries on into the next read
+    rest=b''
+    while True:
+        size=BLOCK_SIZE if length is None else min(BLOCK_SIZE, length-read)
+        data=file.read(size) if size > 0 else b''
+        read += len(data)
+        block=rest+data
+        if not block:
+            break
+        rest=b''
+        if data:
+            # only ever search whole lines, unless they're very long
+            cut=_after_last_line_end(block)
+            if not cut and len(block) < MAX_LINE_LENGTH:
+                rest=block
+                continue
+            if cut:
+                block, rest=block[:cut], block[cut:]
+        text=_decode(block, encoding)
+        starts=_line_starts(text)
+        # keep a running count of bytes up to each match
+        position=0
+        for start, end in matching_lines(text, starts, words):
+            offset += len(_encode(text[position:start], encoding))
+            position=start
+            yield line_number+bisect_right(starts, start)-1, offset, text[start:end]
+        line_number += len(starts)-1
+        if text.endswith(('\n', '\r')):
+            line_number += 1
+        offset += len(_encode(text[position:], encoding))
+    if totals is not None:
+        totals[0] += line_number-1
+        totals[1] += offset
+
+def _after_last_line_end(block):
+    '''the offset just after the last line ending in block, or 0 if there isn't one'''
+    # a \r at the very end could be the start of a \r\n
+    end=len(block)-1 if block.endswith(b'\r') else len(block)
+    return max(block.rfind(b'\n', 0, end), block.rfind(b'\r', 0, end))+1
+
+def _line_starts(text):
+    '''offsets of the start of each line in text, for any kind of line ending'''
+    if '\r' not in text:
+        return line_starts(text)
+    starts=[0]
+    starts.extend(match.end() for match in _line_end.finditer(text))
+    if starts[-1] == len(text):
+        starts.pop()
+    return starts
+
+def _line_start_at(file, pos):
+    '''the offset of the first line starting at or after pos in a file opened in binary mode'''
+    if pos == 0:
+        return 0
+    offset=pos-1
+    file.seek(offset)
+    while True:
+        data=file.read(BLOCK_SIZE)
+        if not data:
+            return offset
+        match=_line_end_bytes.search(data)
+        if match is not None:
+            if match.group() == b'\r' and match.end() == len(data) and file.read(1) == b'\n':
+                return offset+match.end()+1
+            return offset+match.end()
+        offset += len(data)
+
+def search_files(filenames, q, processes=None, limit=None, encoding=None):
+    '''
+    search lots of files at once in a pool of processes, giving (filename,
+    line number, byte offset, line) for each matching line.  big files are
+    split up between processes too.  results come back a piece of a file
+    at a time, as each is finished, and stop after limit matches (if given).
+    files that can't be read, or aren't regular files, give (filename,
+    None, None, error message).
+    '''
+    if encoding is None:
+        encoding=locale.getpreferredencoding(False)
+    tasks=[]
+    for n, filename in enumerate(filenames):
+        error=_not_a_file(filename)
+        if error is not None:
+            yield filename, None, None, error
+            continue
+        try:
+            size=os.path.getsize(filename)
+        except OSError:
+            size=0
+        starts=list(range(0, size, TASK_SIZE)) or [0]
+        for i, start in enumerate(starts):
+            tasks.append((n, filename, i, start, min(start+TASK_SIZE, size), q, encoding))
+    if not tasks:
+        return
+    # line numbers for a piece of a file aren't known until the pieces
+    # before it are done, so hold on to its results until then
+    finished=[{} for filename in filenames]
+    next_piece=[0]*len(filenames)
+    line_numbers=[0]*len(filenames)
+    failed=set()
+    count=0
+    pool=multiprocessing.Pool(processes)
+    try:
+        for n, i, lines, matches in pool.imap_unordered(_search_task, tasks):
+            if n in failed:
+                continue
+            if lines is None:
+                failed.add(n)
+                finished[n]=None
+                yield filenames[n], None, None, matches
+                continue
+            finished[n][i]=(lines, matches)
+            while next_piece[n] in finished[n]:
+                lines, matches=finished[n].pop(next_piece[n])
+                next_piece[n] += 1
+                for line_number, offset, line in matches:
+                    yield filenames[n], line_numbers[n]+line_number, offset, line
+                    count += 1
+                    if limit is not None and count >= limit:
+                        return
+                line_numbers[n] += lines
+    finally:
+        pool.terminate()
+        pool.join()
+
+def _not_a_file(filename):
+    '''
+    an error message if filename is there but isn't a regular file.  fifos
+    and devices say they're empty (so would be searched as one piece) and
+    may never end, so they're left out.  anything missing is left for
+    opening it to report
+    '''
+    if os.path.exists(filename) and not os.path.isfile(filename):
+        return '%s: not a regular file' % filename
+    return None
+
+def _search_task(task):
+    '''search one piece of a file, in a worker process'''
+    n, filename, i, start, end, q, encoding=task
+    try:
+        file=open(filename, 'rb')
+        try:
+            # search the lines that start in this piece
+            start=_line_start_at(file, start)
+            end=_line_start_at(file, end)
+            file.seek(start)
+            totals=[0, 0]
+            matches=[(line_number, start+offset, line) for line_number, offset, line
+                        in _search(file, q, encoding, max(end-start, 0), totals)]
+            return n, i, totals[0], matches
+        finally:
+            file.close()
+    except (IOError, OSError):
+        return n, i, None, str(sys.exc_info()[1])
+
+def _decode(data, encoding):
+    if str is bytes:
+        return data
+    # bytes that aren't valid in the encoding are kept as they are
+    return data.decode(encoding, 'surrogateescape')
+
+def _encode(text, encoding):
+    if str is bytes:
+        return text
+    return text.encode(encoding, 'surrogateescape')
+
+def _binary(stream):
+    return getattr(stream, 'buffer', stream)
+
+def _search_one_by_one(filenames, q, encoding):
+    '''the same as search_files, but without starting any other processes'''
+    for filename in filenames:
+        if filename == '-':
+            file=_binary(sys.stdin)
+        else:
+            error=_not_a_file(filename)
+            if error is not None:
+                yield filename, None, None, error
+                continue
+            try:
+                file=open(filename, 'rb')
+            except IOError:
+                yield filename, None, None, str(sys.exc_info()[1])
+                continue
+        try:
+            for line_number, offset, line in search_file(file, q, encoding):
+                yield filename, line_number, offset, line
+        finally:
+            if filename != '-':
+                file.close()
+
+def _find_files(paths):
+    '''the paths given, with any directories replaced by the files in them'''
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:]=sorted(d for d in dirnames if not d.startswith('.'))
+                for filename in sorted(filenames):
+                    if not filename.startswith('.'):
+                        yield os.path.join(dirpath, filename)
+        else:
+            yield path
+
+def main(args=None):
+    parser=optparse.OptionParser(usage='%prog [options] "words to find" [file or directory ...]')
+    parser.add_option('-n', '--line-number', action='store_true', default=False,
+                      help='print the line number of each matching line')
+    parser.add_option('-b', '--byte-offset', action='store_true', default=False,
+                      help='print the byte offset of each matching line')
+    parser.add_option('-m', '--max-count', type='int', default=None,
+                      help='stop after this many matching lines')
+    parser.add_option('-j', '--jobs', type='int', default=None,
+                      help='how many files to search at once (defaults to one per cpu)')
+    parser.add_option('--encoding', default=None,
+                      help='encoding of the files (defaults to the locale\'s)')
+    options, args=parser.parse_args(args)
+    if not args:
+        parser.error('no search given')
+    q=args[0]
+    filenames=list(_find_files(args[1:])) or ['-']
+    encoding=options.encoding or locale.getpreferredencoding(False)
+    if '-' in filenames or options.jobs == 1 or (len(filenames) == 1 and options.jobs is None):
+        results=_search_one_by_one(filenames, q, encoding)
+    else:
+        results=search_files(filenames, q, options.jobs, options.max_count, encoding)
+    show_filenames=len(filenames) > 1 or len(args) > 1 and os.path.isdir(args[1])
+    out=_binary(sys.stdout)
+    count=0
+    errors=False
+    for filename, line_number, offset, line in results:
+        if line_number is None:
+            sys.stderr.write('%s\n' % line)
+            errors=True
+            continue
+        prefix=[]
+        if show_filenames:
+            prefix.append(filename)
+        if options.line_number:
+            prefix.append(str(line_number))
+        if options.byte_offset:
+            prefix.append(str(offset))
+        if prefix:
+            out.write(_encode(':'.join(prefix)+':', encoding))
+        out.write(_encode(line.rstrip('\r\n'), encoding)+b'\n')
+        count += 1
+        if options.max_count is not None and count >= options.max_count:
+            results.close()
+            break
+    out.flush()
+    # the same exit status as grep
+    if errors:
+        return 2
+    return 0 if count else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
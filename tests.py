@@ -1,7 +1,28 @@
 import unittest
+import gc
+import io
+import mmap
+import os
 import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import weakref
 
-from model import Document, UndoableDocument
+import model
+from model import Document, UndoableDocument, VisibleSections, apply_visible_changes
+from background import SaveScheduler, SearchScheduler
+from events import Event
+import bench
+import search
+from journal import journal_filename
+from pipe import SocketPipe, forward
+from preferences import FileStore, Preferences
+from refresh import Refresher
+from rope import MappedFile, Rope
+from wordindex import WordIndex
 
 class DocumentTestCase(unittest.TestCase):
 
@@ -51,6 +72,20 @@ class DocumentTestCase(unittest.TestCase):
         self.doc.search('')
         self.assertEqual(self.doc.visible_text, 'hello there\nthis is a test\nof search')
     
+    def test_search_joins_lines(self):
+        self.doc.insert(0,'hello there\nhello again\nthis is a test\nhello\nhello\nhello')
+        self.doc.search('hello')
+        self.assertEqual(self.doc.visible_text, 'hello there\nhello again\nhello\nhello\nhello')
+        self.assertEqual(len(self.doc._visible), 2)
+        
+        self.doc.search('hello t')
+        self.assertEqual(self.doc.visible_text, 'hello there')
+        self.assertEqual(len(self.doc._visible), 1)
+        
+        self.doc.search('hello')
+        self.doc.insert(12,'hi ')
+        self.assertEqual(self.doc.text, 'hello there\nhi hello again\nthis is a test\nhello\nhello\nhello')
+    
     def test_search_multiple_words(self):
         self.doc.insert(0,'hello there\nthis is a test\nof search')
         self.doc.search('this test')
@@ -108,6 +143,164 @@ class DocumentTestCase(unittest.TestCase):
         # finally check underlying text matches what we expect
         self.assertEqual(self.doc.text, 'lo therello th\nthis is a test\nof search\n')
     
+    def test_search_against_every_line(self):
+        words=['apple','Banana','cherry','date','APPLES','an']
+        lines=[' '.join(random.choice(words) for i in range(random.choice(range(4))))+'\n' for i in range(200)]
+        self.doc.insert(0,''.join(lines))
+        for q in ['apple','an','banana apple','APPLES date an','Ap','zzz']:
+            self.doc.search(q)
+            search_words=q.lower().split()
+            expected=''.join(line for line in lines if all(w in line.lower() for w in search_words))
+            if expected.endswith('\n'):
+                expected=expected[:-1]
+            self.assertEqual(self.doc.visible_text, expected)
+    
+    def test_search_as_you_type(self):
+        words=['meeting','meet','Monday','notes','mee','tin']
+        self.doc.insert(0,''.join(' '.join(random.choice(words) for i in range(3))+'\n' for i in range(100)))
+        typed=['m','me','mee','meet','meeti','meet','meet ','meet n','meet no','meet n','meet','me','mon','','mee tin']
+        for q in typed:
+            self.doc.search(q)
+            refined=self.doc.visible_text
+            fresh=Document()
+            fresh.insert(0,self.doc.text)
+            fresh.search(q)
+            self.assertEqual(refined, fresh.visible_text)
+        
+        # going back to an earlier search reuses its results
+        self.doc.search('m')
+        self.doc.search('me')
+        lines=self.doc._search_stack[-1][1]
+        self.doc.search('mee')
+        self.assertEqual(len(self.doc._search_stack), 3)
+        self.doc.search('me')
+        self.assertEqual(len(self.doc._search_stack), 2)
+        self.assert_(self.doc._search_stack[-1][1] is lines)
+        
+        # but editing the text throws them away
+        self.doc.insert(0,'zmee')
+        self.assertEqual(self.doc._search_stack, [])
+        self.doc.search('zmee')
+        self.assert_(self.doc.visible_text.startswith('zmee'))
+    
+    def test_remove_leaves_later_sections_alone(self):
+        self.doc.insert(0,'hello a\nx\nhello b\ny\nhello c\nz')
+        self.doc.search('hello')
+        self.assertEqual(self.doc.visible_text, 'hello a\nhello b\nhello c')
+        
+        self.doc.remove(6, 3)
+        self.assertEqual(self.doc.visible_text, 'hello ello b\nhello c')
+        self.assertEqual(self.doc.text, 'hello ello b\nx\ny\nhello c\nz')
+        
+        self.doc.insert(len(self.doc.visible_text), '!')
+        self.assertEqual(self.doc.text, 'hello ello b\nx\ny\nhello c!\nz')
+    
+    def test_remove_across_many_sections(self):
+        self.doc.insert(0,''.join('hello %d\nother %d\n' % (i, i) for i in range(20)))
+        self.doc.search('hello')
+        visible_text=self.doc.visible_text
+        
+        self.doc.remove(3, 9*8)
+        self.assertEqual(self.doc.visible_text, visible_text[:3]+visible_text[3+9*8:])
+        self.assertEqual(len(self.doc.visible_sections), 11)
+        self.assertEqual(self.doc.text, 'hello 9\n'+
+                         ''.join('other %d\n' % i for i in range(9))+
+                         ''.join('other %d\nhello %d\n' % (i, i+1) for i in range(9, 19))+
+                         'other 19\n')
+    
+    def test_apply_edits(self):
+        self.doc.insert(0,''.join('hello %d\nother %d\n' % (i, i) for i in range(10)))
+        for q in ['', 'hello']:
+            self.doc.search(q)
+            visible_text=self.doc.visible_text
+            edits=[('insert', 0, 'start\n'), ('remove', 3, 20), ('insert', 30, 'x'),
+                   ('remove', 30, 2), ('insert', 30, 'y'), ('insert', len(visible_text), '!')]
+            self.doc.apply_edits(edits)
+            self.assertEqual(self.doc.visible_text, 'start\n'+visible_text[:3]+visible_text[23:30]+
+                             'xy'+visible_text[32:]+'!')
+            self.assertEqual(self.doc.current_offset, len(self.doc.visible_text))
+    
+    def test_apply_edits_across_groups(self):
+        text=''.join('hello %d\nother %d\n' % (i, i) for i in range(10))
+        self.doc.insert(0, text)
+        self.doc.search('hello')
+        sections=self.doc.visible_sections
+        # each remove joins two visible lines, in separate places
+        edits=[('remove', 3, 8), ('remove', sections.visible_offset(5)+3, 8),
+               ('remove', sections.visible_offset(8)+2, 8)]
+        self.doc.apply_edits(edits)
+        self.assertEqual(self.doc.visible_text, 'hello 1\nhello 2\nhello 3\nhello 4\nhello 6\nhello 7\nhello 9')
+        # the same as making the edits one at a time
+        doc=self.doc.__class__()
+        doc.insert(0, text)
+        doc.search('hello')
+        for kind, offset, length in reversed(edits):
+            doc.remove(offset, length)
+        self.assertEqual(self.doc.text, doc.text)
+        self.doc.search('')
+        self.assert_(self.doc.text.startswith('hello 1\nother 0\nother 1\nhello 2\n'))
+        self.assert_('hello 6\nother 5\nother 6\nhello 7\n' in self.doc.text)
+    
+    def test_apply_edits_all_or_nothing(self):
+        self.doc.insert(0,'hello there\nthis is a test\nof search\nhello again')
+        self.doc.search('hello')
+        text=self.doc.text
+        for edits in [[('insert', 0, 'a'), ('remove', 10, 100)],
+                      [('remove', 2, 5), ('remove', 6, 2)],
+                      [('remove', 2, 5), ('insert', 4, 'a')],
+                      [('replace', 0, 'a')]]:
+            self.assertRaises(ValueError, self.doc.apply_edits, edits)
+            self.assertEqual(self.doc.text, text)
+        
+        def fail(offset, text):
+            raise IOError("out of space")
+        insert_text=self.doc._insert_text
+        self.doc._insert_text=fail
+        self.assertRaises(IOError, self.doc.apply_edits, [('insert', 0, 'a'), ('remove', 3, 12)])
+        del self.doc._insert_text
+        self.assertEqual(self.doc.text, text)
+        self.assertEqual(self.doc.visible_text, 'hello there\nhello again')
+    
+    def test_open_mapped(self):
+        dirname=tempfile.mkdtemp()
+        try:
+            filename=os.path.join(dirname, 'notes.txt')
+            file=open(filename, 'wb')
+            file.write(b'hello there\r\nthis is a test\rof search\nhello again\n'*5)
+            file.close()
+            self.doc.open(filename, mapped=True)
+            text='hello there\nthis is a test\nof search\nhello again\n'*5
+            self.assertEqual(self.doc.text, text)
+            self.doc.search('hello')
+            self.assertEqual(self.doc.visible_text, '\n'.join(['hello there', 'hello again']*5))
+            
+            self.doc.remove(3, 20)
+            self.doc.save()
+            self.assertEqual(os.listdir(dirname), ['notes.txt'])
+            saved=self.doc.text
+            self.doc.search('')
+            self.doc.insert(0, 'more\n')
+            self.doc.open(filename)
+            self.assertEqual(self.doc.text, saved)
+        finally:
+            shutil.rmtree(dirname)
+    
+    def test_view(self):
+        self.doc.insert(0,'hello there\nthis is a test\nof search\nhello again\n\nhello')
+        for q in ['', 'hello', 'test', 'o', '876fdjfdsf87']:
+            self.doc.search(q)
+            visible_text=self.doc.visible_text
+            view=self.doc.view
+            self.assertEqual(len(view), len(visible_text))
+            self.assertEqual(list(view.lines()), visible_text.splitlines(True))
+            for i in range(20):
+                start=random.choice(range(len(visible_text)+1))
+                end=random.choice(range(start, len(visible_text)+1))
+                self.assertEqual(view[start:end], visible_text[start:end])
+                self.assertEqual(''.join(view.chunks(start, end)), visible_text[start:end])
+            if visible_text:
+                self.assertEqual(view[-1], visible_text[-1])
+    
     def test_insert_remove(self):
         # in the simple case (without search) inserting them remove should
         # have no effect
@@ -153,6 +346,963 @@ class DocumentTestCase(unittest.TestCase):
             self.assertEqual( self.doc.visible_text, visible_text_before )
             self.assertEqual( self.doc.text, text_before )
 
+class FakeTextCtrl(object):
+    # just enough of a StyledTextCtrl to apply visible changes to
+    
+    def __init__(self, text):
+        self.text=text
+        self.calls=0
+    
+    def SetTargetStart(self, pos):
+        self.target_start=pos
+    
+    def SetTargetEnd(self, pos):
+        self.target_end=pos
+    
+    def ReplaceTarget(self, text):
+        self.text=self.text[:self.target_start]+text+self.text[self.target_end:]
+        self.calls += 1
+    
+    def InsertText(self, pos, text):
+        self.text=self.text[:pos]+text+self.text[pos:]
+        self.calls += 1
+
+class VisibleChangesTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.doc=Document()
+        self.doc.insert(0,'hello there\nthis is a test\nof search\nhello again\n\nhello')
+        self.text_ctrl=FakeTextCtrl(self.doc.visible_text)
+    
+    def search(self, q):
+        previous=self.doc.visible_sections
+        self.doc.search(q)
+        apply_visible_changes(self.text_ctrl, self.doc.visible_changes(previous))
+        self.assertEqual(self.text_ctrl.text, self.doc.visible_text)
+    
+    def test_changes(self):
+        for q in ['hello', 'hello t', 'hello', '', 'e', 'xyz', 'of', '', 'search', 'hello', 'hello a']:
+            self.search(q)
+    
+    def test_minimal(self):
+        self.search('hello')
+        calls=self.text_ctrl.calls
+        # narrowing the search down just removes the lines that no longer match
+        self.search('hello again')
+        self.assertEqual(self.text_ctrl.calls-calls, 2)
+        self.assertEqual(self.doc.visible_changes(self.doc.visible_sections), [])
+    
+    def test_random_searches(self):
+        words=['apple','banana','cherry','date']
+        self.doc=Document()
+        self.doc.insert(0,''.join(' '.join(random.choice(words) for i in range(2))+'\n' for i in range(100)))
+        self.text_ctrl=FakeTextCtrl(self.doc.visible_text)
+        for i in range(50):
+            self.search(random.choice(['']+words+['an', 'apple date', 'e b']))
+
+class VisibleSectionsTestCase(unittest.TestCase):
+    
+    def test_insert_delete(self):
+        sections=[(i*10, i % 4) for i in range(1000)]
+        visible=VisibleSections(Document.Visible(offset, length) for offset, length in sections)
+        for n in range(100):
+            i=random.randrange(len(sections))
+            delta=random.choice([-3, 5])
+            visible.shift(i, delta)
+            sections[i:]=[(offset+delta, length) for offset, length in sections[i:]]
+            starts=sorted(random.sample(range(len(sections)), 6))
+            spans=[(start, min(start+random.choice([1, 2]), next_start))
+                    for start, next_start in zip(starts, starts[1:]+[len(sections)])]
+            deleted=[(start, sections[start:stop]) for start, stop in spans]
+            visible.delete(spans)
+            for start, stop in reversed(spans):
+                del sections[start:stop]
+            self.assertEqual( list(visible.sections()), sections )
+            self.assertEqual( visible.total(), sum(length for offset, length in sections) )
+            if n % 2:
+                # put them back again
+                visible.insert(deleted)
+                for start, values in deleted:
+                    sections[start:start]=values
+                self.assertEqual( list(visible.sections()), sections )
+                i=random.randrange(len(sections))
+                self.assertEqual( visible.visible_offset(i), sum(length for offset, length in sections[:i]) )
+
+class SearchSchedulerTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.doc=UndoableDocument()
+        self.doc.insert(0,'hello there\nthis is a test\nof search\nhello again')
+        self.finished=threading.Event()
+        self.jobs=[]
+        self.scheduler=SearchScheduler(self.doc, self.search_finished, delay=0.01)
+    
+    def search_finished(self, job):
+        self.jobs.append(job)
+        self.doc.search(job.q, job)
+        self.finished.set()
+    
+    def test_search(self):
+        self.scheduler.schedule('hello')
+        self.assert_(self.finished.wait(5))
+        self.assertEqual(self.doc.current_search, 'hello')
+        self.assertEqual(self.doc.visible_text, 'hello there\nhello again')
+    
+    def test_only_latest_delivered(self):
+        self.scheduler.delay=0.2
+        for q in ['t', 'te', 'tes', 'test']:
+            self.scheduler.schedule(q)
+        self.assert_(self.finished.wait(5))
+        self.scheduler.schedule('of')
+        self.scheduler.cancel()
+        self.assertEqual([job.q for job in self.jobs], ['test'])
+        self.assertEqual(self.doc.visible_text, 'this is a test')
+    
+    def test_clear(self):
+        self.doc.search('hello')
+        self.scheduler.delay=5
+        self.scheduler.schedule('test')
+        self.scheduler.schedule('')
+        # shown straight away, and the search waiting is dropped
+        self.assertEqual([job.q for job in self.jobs], [''])
+        self.assertEqual(self.doc.visible_text, self.doc.text)
+        self.assertEqual(self.scheduler._timer, None)
+    
+    def test_cancel_while_running(self):
+        job=self.doc.search_job('hello', snapshot=True)
+        self.assert_( not job.run(lambda: True) )
+        self.assertEqual( job.spans, None )
+    
+    def test_snapshot_unaffected_by_edits(self):
+        job=self.doc.search_job('hello', snapshot=True)
+        self.doc.insert(0, 'hello ')
+        self.assert_( job.run() )
+        self.assertEqual( job.spans, [(0, 12), (37, 11)] )
+        # the results are out of date, so searching again uses the new text
+        self.doc.search('hello', job)
+        self.assertEqual( self.doc.visible_text, 'hello hello there\nhello again' )
+
+class SaveSchedulerTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.dirname=tempfile.mkdtemp()
+        self.now=0
+        self.saves=[]
+        self.scheduler=SaveScheduler(interval=10, clock=lambda: self.now)
+        self.docs=[]
+        for name in ['one', 'two']:
+            doc=UndoableDocument()
+            doc.save_as(os.path.join(self.dirname, name))
+            self.scheduler.add(doc, self.saved)
+            self.docs.append(doc)
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def saved(self, doc, error):
+        self.saves.append((doc, error))
+    
+    def _read(self, doc):
+        file=open(doc.filename)
+        try:
+            return file.read()
+        finally:
+            file.close()
+    
+    def test_saves_spread_out(self):
+        for doc in self.docs:
+            doc.insert(0, 'hello')
+        self.now=4
+        self.scheduler.poll()
+        self.now=5
+        self.scheduler.poll()
+        self.scheduler.flush()
+        self.assertEqual( len(self.saves), 1 )
+        saved=self.saves[0][0]
+        self.assert_( not saved.is_modified )
+        self.assertEqual( self._read(saved), 'hello' )
+        
+        self.now=10
+        self.scheduler.poll()
+        self.scheduler.flush()
+        self.assertEqual( [doc for doc, error in self.saves], [saved]+[doc for doc in self.docs if doc is not saved] )
+        self.assert_( not self.docs[0].is_modified and not self.docs[1].is_modified )
+        # nothing has changed, so nothing more to save
+        self.now=100
+        self.scheduler.poll()
+        self.scheduler.flush()
+        self.assertEqual( len(self.saves), 2 )
+        self.assertEqual( sorted(os.listdir(self.dirname)), ['one', 'two'] )
+    
+    def test_edit_while_saving(self):
+        doc=self.docs[0]
+        doc.insert(0, 'hello')
+        job=doc.save_job()
+        doc.insert(0, 'more ')
+        job.run()
+        doc.saved(job)
+        self.assertEqual( self._read(doc), 'hello' )
+        self.assert_( doc.is_modified )
+    
+    def test_older_save_finishing_last(self):
+        doc=self.docs[0]
+        doc.insert(0, 'hello')
+        job=doc.save_job()
+        doc.insert(0, 'more ')
+        doc.save()
+        job.run()
+        doc.saved(job)
+        self.assertEqual( self._read(doc), 'more hello' )
+        self.assert_( not doc.is_modified )
+        self.assertEqual( sorted(os.listdir(self.dirname)), ['one', 'two'] )
+    
+    def test_failed_save(self):
+        doc=self.docs[0]
+        doc.insert(0, 'hello')
+        def fail():
+            raise UnicodeError('cannot encode')
+        def failing_job():
+            job=model.SaveJob(doc)
+            job._rope.chunks=fail
+            return job
+        doc.save_job=failing_job
+        self.scheduler.save(doc, self.saved)
+        self.scheduler.flush()
+        self.assertEqual( [(saved, type(error)) for saved, error in self.saves], [(doc, UnicodeError)] )
+        self.assert_( doc.is_modified )
+        # later saves still happen
+        del doc.save_job
+        doc.insert(0, 'and ')
+        self.scheduler.save(doc, self.saved)
+        self.scheduler.flush()
+        self.assertEqual( self.saves[-1], (doc, None) )
+        self.assertEqual( self._read(doc), 'and hello' )
+        self.assertEqual( sorted(os.listdir(self.dirname)), ['one', 'two'] )
+    
+    def test_save_through_symlink(self):
+        if not hasattr(os, 'symlink'):
+            return
+        doc=self.docs[0]
+        link=os.path.join(self.dirname, 'link')
+        os.symlink(doc.filename, link)
+        os.chmod(doc.filename, 0o640)
+        doc.insert(0, 'hello')
+        doc.save_as(link)
+        self.assert_( os.path.islink(link) )
+        self.assertEqual( self._read(self.docs[0]), 'hello' )
+        self.assertEqual( os.stat(link).st_mode & 0o777, 0o640 )
+    
+    def test_new_file_mode(self):
+        doc=Document()
+        doc.insert(0, 'hello')
+        filename=os.path.join(self.dirname, 'new')
+        doc.save_as(filename)
+        self.assertEqual( os.stat(filename).st_mode & 0o777, 0o666 & ~model._UMASK )
+        os.remove(filename)
+
+class JournalTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.dirname=tempfile.mkdtemp()
+        self.filename=os.path.join(self.dirname, 'notes.obs')
+        self.doc=UndoableDocument()
+        self.doc.insert(0,'hello there\nthis is a test\nof search\nhello again')
+        self.doc.save_as(self.filename)
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def _reopen(self, doc=None):
+        (doc or self.doc).flush_journal(wait=True)
+        doc=UndoableDocument()
+        doc.open(self.filename)
+        return doc
+    
+    def test_recover_unsaved_edits(self):
+        self.assert_( not os.path.exists(journal_filename(self.filename)) )
+        self.doc.insert(5, ' you')
+        self.doc.search('hello')
+        self.doc.remove(3, 15)
+        self.doc.undo()
+        self.doc.insert(0, 'caf\xe9 ')
+        doc=self._reopen()
+        self.assertEqual( doc.text, self.doc.text )
+        self.assert_( doc.is_modified )
+        
+        # carries on from where the journal left off
+        doc.insert(0, 'more ')
+        self.assertEqual( self._reopen(doc).text, doc.text )
+    
+    def test_save_drops_saved_edits(self):
+        self.doc.insert(0, 'a')
+        self.doc.flush_journal(wait=True)
+        self.assertEqual( os.path.getsize(journal_filename(self.filename)), 33+1 )
+        self.doc.save()
+        self.assert_( not os.path.exists(journal_filename(self.filename)) )
+        self.assert_( not self._reopen().is_modified )
+    
+    def test_edits_while_saving_kept(self):
+        self.doc.insert(0, 'a')
+        job=self.doc.save_job()
+        self.doc.insert(0, 'b')
+        job.run()
+        self.doc.saved(job)
+        self.assertEqual( self._reopen().text, self.doc.text )
+    
+    def test_cut_off_edit_ignored(self):
+        self.doc.insert(0, 'a')
+        self.doc.insert(0, 'b')
+        self.doc.flush_journal(wait=True)
+        file=open(journal_filename(self.filename), 'r+b')
+        file.truncate(os.path.getsize(journal_filename(self.filename))-1)
+        file.close()
+        self.assertEqual( self._reopen().text, 'a'+self.doc.text[2:] )
+    
+    def test_changed_file_not_recovered(self):
+        self.doc.insert(0, 'a')
+        self.doc.flush_journal(wait=True)
+        file=open(self.filename, 'w')
+        file.write('something else')
+        file.close()
+        self.assertEqual( self._reopen().text, 'something else' )
+
+    def test_checkpoint_restore_recovered(self):
+        text=self.doc.text
+        start=self.doc.undo_node
+        for i in range(UndoableDocument.CHECKPOINT_INTERVAL*3):
+            self.doc.insert(0, 'edit %d\n' % i)
+            self.doc._can_coalesce=False
+        fsyncs=[]
+        fsync=os.fsync
+        os.fsync=lambda fd: (fsyncs.append(fd), fsync(fd))
+        try:
+            # far enough back to restore a checkpoint
+            self.doc.jump_to(start)
+            self.doc.flush_journal(wait=True)
+        finally:
+            os.fsync=fsync
+        self.assertEqual( self.doc.text, text )
+        self.assertEqual( len(fsyncs), 1 )
+        self.assertEqual( self._reopen().text, text )
+    
+    def test_checkpoint_restore_size(self):
+        self.doc.insert(0, 'some notes\n'*20000)
+        self.doc.save()
+        self.doc.open(self.filename)
+        start=self.doc.undo_node
+        for i in range(UndoableDocument.CHECKPOINT_INTERVAL*3):
+            self.doc.insert(len(self.doc.text), 'edit %d\n' % i)
+            self.doc._can_coalesce=False
+        self.doc.flush_journal(wait=True)
+        size=os.path.getsize(journal_filename(self.filename))
+        self.doc.jump_to(start)
+        self.doc.flush_journal(wait=True)
+        # only the text that changed is journalled, not the whole document
+        self.assert_( os.path.getsize(journal_filename(self.filename))-size < len(self.doc.text)//10 )
+        self.assertEqual( self._reopen().text, self.doc.text )
+    
+    def test_close_discards(self):
+        self.doc.insert(0, 'a')
+        self.doc.flush_journal(wait=True)
+        self.assert_( os.path.exists(journal_filename(self.filename)) )
+        # closed without saving
+        self.doc.close()
+        self.assert_( not os.path.exists(journal_filename(self.filename)) )
+        doc=self._reopen(UndoableDocument())
+        self.assertEqual( doc.text, 'hello there\nthis is a test\nof search\nhello again' )
+        self.assert_( not doc.is_modified )
+    
+    def test_revert_discards(self):
+        self.doc.insert(0, 'a')
+        self.doc.flush_journal(wait=True)
+        self.doc.revert()
+        self.assertEqual( self.doc.text, 'hello there\nthis is a test\nof search\nhello again' )
+        self.assert_( not self.doc.is_modified )
+        self.assert_( not self.doc.can_undo() )
+        self.assert_( not os.path.exists(journal_filename(self.filename)) )
+        # and still keeps a journal of edits after that
+        self.doc.insert(0, 'b')
+        self.assertEqual( self._reopen().text, self.doc.text )
+
+class SocketPipeTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        name='notecomb-tests-%d' % os.getpid()
+        self.server=SocketPipe(name)
+        self.client=SocketPipe(name)
+    
+    def tearDown(self):
+        self.server.close()
+        if os.path.isdir(self.server.dir):
+            os.rmdir(self.server.dir)
+    
+    def test_write_read(self):
+        self.server.listen()
+        self.assertEqual( self.server.read(), None )
+        files=['/some/file-%d.obs' % i for i in range(1000)]
+        self.client.write(files)
+        self.client.write(['another'])
+        self.assertEqual( self.server.read(), files )
+        self.assertEqual( self.server.read(), ['another'] )
+        self.assertEqual( self.server.read(), None )
+    
+    def test_callback(self):
+        received=[]
+        finished=threading.Event()
+        def callback(data):
+            received.append(data)
+            finished.set()
+        # the other end can take a moment to start listening
+        timer=threading.Timer(0.1, self.server.listen, (callback,))
+        timer.start()
+        self.client.write(['file.obs'])
+        timer.join()
+        self.assert_( finished.wait(5) )
+        self.assertEqual( received, [['file.obs']] )
+    
+    def test_forward(self):
+        name='notecomb-tests-%d' % os.getpid()
+        # nothing running to forward to
+        self.assertEqual( forward(name, ['file.obs']), False )
+        self.server.listen()
+        self.assertEqual( forward(name, ['file.obs']), True )
+        self.assertEqual( self.server.read(), ['file.obs'] )
+    
+    def test_not_answering(self):
+        # something listening that never reads anything
+        os.mkdir(self.server.dir, 0o700)
+        sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.bind(self.server.path)
+            sock.listen(1)
+            self.client.READ_TIMEOUT=0.1
+            started=time.time()
+            self.assertRaises( socket.timeout, self.client.write, ['file.obs'], 0 )
+            self.assert_( time.time()-started < 2 )
+        finally:
+            sock.close()
+            os.remove(self.server.path)
+    
+    def test_forward_not_answering(self):
+        os.mkdir(self.server.dir, 0o700)
+        sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        read_timeout=SocketPipe.READ_TIMEOUT
+        SocketPipe.READ_TIMEOUT=0.1
+        try:
+            sock.bind(self.server.path)
+            sock.listen(1)
+            # reported, rather than starting up as if nothing was running
+            self.assertRaises( socket.timeout, forward, 'notecomb-tests-%d' % os.getpid(), ['file.obs'] )
+        finally:
+            SocketPipe.READ_TIMEOUT=read_timeout
+            sock.close()
+            os.remove(self.server.path)
+    
+    def test_private(self):
+        self.server.listen()
+        self.assertEqual( os.stat(self.server.dir).st_mode & 0o777, 0o700 )
+        self.server.close()
+        # someone else could get to the socket, so it isn't used
+        os.chmod(self.server.dir, 0o755)
+        self.assertRaises( socket.error, self.server.listen )
+        self.assertRaises( socket.error, self.client.write, ['file.obs'], 0 )
+    
+    def test_stale_socket(self):
+        # left behind by an instance that didn't shut down cleanly
+        os.mkdir(self.server.dir, 0o700)
+        sock=socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.server.path)
+        sock.close()
+        self.server.listen()
+        self.client.write(['file.obs'])
+        self.assertEqual( self.server.read(), ['file.obs'] )
+
+class Listener(object):
+    
+    def __init__(self):
+        self.received=[]
+    
+    def changed(self, *args):
+        self.received.append(args)
+
+class EventTestCase(unittest.TestCase):
+    
+    def test_notify(self):
+        event=Event()
+        listener=Listener()
+        received=[]
+        event += listener.changed
+        event += lambda key, value: received.append(value)
+        event('key', 1)
+        self.assertEqual( listener.received, [('key', 1)] )
+        self.assertEqual( received, [1] )
+        event -= listener.changed
+        event('key', 2)
+        self.assertEqual( listener.received, [('key', 1)] )
+        self.assertEqual( received, [1, 2] )
+    
+    def test_weak_listeners(self):
+        event=Event()
+        listeners=[Listener() for i in range(10)]
+        for listener in listeners:
+            event += listener.changed
+        self.assertEqual( len(event.listeners), 10 )
+        del listener
+        del listeners[:5]
+        gc.collect()
+        self.assertEqual( len(event.listeners), 5 )
+        event('key', 1)
+        self.assertEqual( list(listener.received for listener in listeners), [[('key', 1)]]*5 )
+        del listeners[:]
+        gc.collect()
+        self.assertEqual( event.listeners, [] )
+        # functions are still held on to
+        received=[]
+        event += lambda key, value: received.append(key)
+        gc.collect()
+        event('key', 2)
+        self.assertEqual( received, ['key'] )
+    
+    def test_batched(self):
+        posted=[]
+        event=Event(posted.append)
+        listener=Listener()
+        event += listener.changed
+        event('a', 1)
+        event('b', 2)
+        event('a', 3)
+        self.assertEqual( listener.received, [] )
+        self.assertEqual( len(posted), 1 )
+        posted.pop()()
+        self.assertEqual( listener.received, [([('a', 1), ('b', 2), ('a', 3)],)] )
+        event('c', 4)
+        self.assertEqual( len(posted), 1 )
+        posted.pop()()
+        self.assertEqual( listener.received[-1], ([('c', 4)],) )
+
+class PreferencesTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.dirname=tempfile.mkdtemp()
+        self.filename=os.path.join(self.dirname, 'prefs')
+        self.prefs=Preferences(FileStore(self.filename))
+    
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+    
+    def test_get_set(self):
+        self.assertEqual( self.prefs.get('missing', 'default'), 'default' )
+        changes=[]
+        self.prefs.changed += lambda key, value: changes.append((key, value))
+        self.prefs.set('recent_files', ['one.obs', 'two.obs'])
+        self.prefs.set('SHOW_LINENUMBERS', False)
+        self.assertEqual( self.prefs.get('recent_files', []), ['one.obs', 'two.obs'] )
+        self.assertEqual( self.prefs.get('SHOW_LINENUMBERS', True), False )
+        self.assertEqual( changes, [('recent_files', ['one.obs', 'two.obs']), ('SHOW_LINENUMBERS', False)] )
+    
+    def test_batched_writes(self):
+        writes=[]
+        store=self.prefs.store
+        write=store.write
+        store.write=lambda items: (writes.append(items), write(items))
+        for x in range(100):
+            self.prefs.set('WINDOW_STATE', (False, x, 0, 640, 480))
+        self.prefs.set('AUTO_SAVE', False)
+        self.assertEqual( writes, [] )
+        self.assert_( not os.path.exists(self.filename) )
+        self.prefs.flush()
+        self.assertEqual( [[key for key, value in items] for items in writes], [['AUTO_SAVE', 'WINDOW_STATE']] )
+        # nothing has changed since
+        self.prefs.flush()
+        self.assertEqual( len(writes), 1 )
+        prefs=Preferences(FileStore(self.filename))
+        self.assertEqual( prefs.get('WINDOW_STATE', None), (False, 99, 0, 640, 480) )
+        self.assertEqual( prefs.get('AUTO_SAVE', True), False )
+    
+    def test_unicode_store(self):
+        # stores like wx.Config give back unicode
+        class UnicodeStore(object):
+            def __init__(self):
+                self.values={}
+            def read(self, key):
+                value=self.values.get(key)
+                if isinstance(value, bytes):
+                    value=value.decode('latin-1')
+                return value
+            def write(self, items):
+                self.values.update(items)
+        store=UnicodeStore()
+        prefs=Preferences(store)
+        prefs.set('recent_files', [u'caf\xe9.obs'])
+        prefs.flush()
+        self.assertEqual( Preferences(store).get('recent_files', []), [u'caf\xe9.obs'] )
+    
+    def test_reads_cached(self):
+        reads=[]
+        store=self.prefs.store
+        read=store.read
+        store.read=lambda key: (reads.append(key), read(key))[1]
+        for i in range(10):
+            self.assertEqual( self.prefs.get('missing', None), None )
+        self.assertEqual( reads, ['missing'] )
+
+class RefresherTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.posted=[]
+        self.refresher=Refresher(self.posted.append)
+        self.doc=UndoableDocument()
+        self.updates=[]
+        self.refresher.add('title', lambda: self.doc.is_modified,
+                           lambda value: self.updates.append(('title', value)))
+        self.refresher.add('undo', lambda: self.doc.can_undo(),
+                           lambda value: self.updates.append(('undo', value)))
+        self._idle()
+    
+    def _idle(self):
+        while self.posted:
+            self.posted.pop(0)()
+    
+    def test_refresh_when_changed(self):
+        self.assertEqual( self.updates, [('title', False), ('undo', False)] )
+        for i in range(100):
+            self.doc.insert(i, 'a')
+            self.refresher.invalidate('title', 'undo')
+        # only one refresh for the whole burst
+        self.assertEqual( len(self.posted), 1 )
+        self._idle()
+        self.assertEqual( self.updates[2:], [('title', True), ('undo', True)] )
+        # nothing that's shown has changed
+        self.doc.insert(0, 'b')
+        self.refresher.invalidate()
+        self._idle()
+        self.assertEqual( len(self.updates), 4 )
+    
+    def test_only_stale_parts(self):
+        self.doc.insert(0, 'a')
+        self.refresher.invalidate('undo')
+        self._idle()
+        self.assertEqual( self.updates[2:], [('undo', True)] )
+
+class BenchTestCase(unittest.TestCase):
+    
+    def test_generate(self):
+        text=bench.generate(64*1024, 100)
+        self.assert_( abs(len(text)-64*1024) < 1024 )
+        doc=Document()
+        doc.insert(0, text)
+        doc.search('marker')
+        self.assertEqual( len(list(doc.visible_sections.sections())), 100 )
+    
+    def test_run(self):
+        out=io.StringIO() if str is not bytes else io.BytesIO()
+        runner=bench.Bench([1024], [1], repeat=1, match='search_one_word', out=out)
+        try:
+            results=runner.run()
+        finally:
+            runner.close()
+        self.assert_( not os.path.exists(runner.dirname) )
+        self.assertEqual( [(result['name'], result['doc']) for result in results],
+                          [('search_one_word', 'Document'), ('search_one_word', 'UndoableDocument')] )
+    
+    def test_no_journal(self):
+        runner=bench.Bench([1024], [1], repeat=1)
+        try:
+            doc=runner.open(UndoableDocument, 1024)
+            doc.insert(0, 'edit\n')
+            doc.flush_journal(wait=True)
+            # nothing written to disk while the timings are running
+            self.assertEqual( os.listdir(runner.dirname), [os.path.basename(runner.filename(1024))] )
+        finally:
+            runner.close()
+    
+    def test_compare(self):
+        def result(name, seconds):
+            return {'name': name, 'doc': 'Document', 'size': 1024, 'sections': None,
+                    'seconds': seconds, 'ops': 1}
+        baseline=[result('open', 0.1), result('insert', 0.1), result('remove', 0.0001)]
+        results=[result('open', 0.11), result('insert', 0.2), result('remove', 0.0005),
+                 result('undo', 1.0)]
+        # only what's slower by more than the threshold, and not just noise
+        self.assertEqual( bench.compare(results, baseline), [(results[1], 0.1, 2.0)] )
+
+class SmallChunkDocumentTestCase(DocumentTestCase):
+    # run the document tests again with tiny chunks, so most edits
+    # end up crossing chunk boundaries
+    
+    def setUp(self):
+        super(SmallChunkDocumentTestCase,self).setUp()
+        self.chunk_size=Rope.CHUNK_SIZE
+        Rope.CHUNK_SIZE=8
+    
+    def tearDown(self):
+        Rope.CHUNK_SIZE=self.chunk_size
+
+class IndexedDocumentTestCase(SmallChunkDocumentTestCase):
+    
+    def setUp(self):
+        super(IndexedDocumentTestCase,self).setUp()
+        self.doc=Document(indexed=True)
+    
+    def test_index_follows_edits(self):
+        self.doc.insert(0,'hello there\nthis is a test\nof search\n'*10)
+        self.doc.remove(0,5)
+        self.doc.insert(0,'goodbye')
+        self.doc.search('goodbye')
+        self.assertEqual(self.doc.visible_text, 'goodbye there')
+        self.doc.search('hello there')
+        self.assertEqual(self.doc.visible_text, '\n'.join(['hello there']*9))
+        self.doc.search('hello')
+        self.doc.remove(0,len(self.doc.visible_text))
+        self.doc.search('hello')
+        self.assertEqual(self.doc.visible_text, '')
+
+class SearchFileTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.block_size=search.BLOCK_SIZE
+        search.BLOCK_SIZE=16
+    
+    def tearDown(self):
+        search.BLOCK_SIZE=self.block_size
+    
+    def test_same_as_document(self):
+        text=''.join(' '.join(random.choice(['Hello', 'there', 'test', 'of', 'the']) for i in range(random.choice(range(5))))+'\n'
+                        for j in range(100))
+        doc=Document()
+        doc.insert(0, text)
+        lines=text.splitlines(True)
+        for q in ['hello', 'the', 'hello there', 'THE of', 'zzz', '']:
+            doc.search(q)
+            matches=list(search.search_file(io.BytesIO(text.encode('utf-8')), q, 'utf-8'))
+            self.assertEqual(''.join(line for n, offset, line in matches).rstrip('\n'), doc.visible_text.rstrip('\n'))
+            for line_number, offset, line in matches:
+                self.assertEqual(lines[line_number-1], line)
+                self.assertEqual(len(''.join(lines[:line_number-1]).encode('utf-8')), offset)
+    
+    def test_line_endings(self):
+        text=''.join(random.choice(['hello there', 'test', '']) + random.choice(['\n', '\r\n', '\r'])
+                        for j in range(100))
+        lines=text.splitlines(True)
+        matches=list(search.search_file(io.BytesIO(text.encode('utf-8')), 'hello', 'utf-8'))
+        self.assertEqual(len(matches), len([line for line in lines if 'hello' in line]))
+        for line_number, offset, line in matches:
+            self.assertEqual(lines[line_number-1], line)
+            self.assertEqual(len(''.join(lines[:line_number-1]).encode('utf-8')), offset)
+    
+    def test_long_line(self):
+        max_line_length=search.MAX_LINE_LENGTH
+        search.MAX_LINE_LENGTH=64
+        try:
+            text='x'*1000 + 'hello\nhello again\n'
+            matches=list(search.search_file(io.BytesIO(text.encode('utf-8')), 'hello', 'utf-8'))
+        finally:
+            search.MAX_LINE_LENGTH=max_line_length
+        # the long line is only read a piece at a time
+        line_number, offset, line=matches[0]
+        self.assertEqual( line_number, 1 )
+        self.assert_( len(line) < 64+search.BLOCK_SIZE )
+        self.assertEqual( text[offset:offset+len(line)], line )
+        self.assertEqual( matches[1:], [(2, 1006, 'hello again\n')] )
+
+class SearchFilesTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.task_size=search.TASK_SIZE
+        search.TASK_SIZE=50
+        self.dirname=tempfile.mkdtemp()
+        self.texts={}
+        for i in range(5):
+            filename=os.path.join(self.dirname, '%d.obs' % i)
+            text=''.join('%s %d\n' % (random.choice(['hello', 'there', 'Hello there']), j)
+                            for j in range(random.choice(range(30))))
+            file=open(filename, 'wb')
+            file.write(text.encode('utf-8'))
+            file.close()
+            self.texts[filename]=text
+    
+    def tearDown(self):
+        search.TASK_SIZE=self.task_size
+        shutil.rmtree(self.dirname)
+    
+    def test_same_as_search_file(self):
+        filenames=sorted(self.texts)+[os.path.join(self.dirname, 'missing.obs')]
+        results=list(search.search_files(filenames, 'hello', 2, encoding='utf-8'))
+        self.assertEqual([r[0] for r in results if r[1] is None], filenames[-1:])
+        for filename, text in self.texts.items():
+            expected=list(search.search_file(io.BytesIO(text.encode('utf-8')), 'hello', 'utf-8'))
+            self.assertEqual([r[1:] for r in results if r[0] == filename], expected)
+    
+    def test_not_a_file(self):
+        fifo=os.path.join(self.dirname, 'fifo')
+        os.mkfifo(fifo)
+        filenames=[fifo, self.dirname]+sorted(self.texts)
+        # nothing ever gets written to the fifo, so it would never finish
+        results=list(search.search_files(filenames, 'hello', 2, encoding='utf-8'))
+        self.assertEqual([r[0] for r in results if r[1] is None], filenames[:2])
+        results=list(search._search_one_by_one(filenames, 'hello', 'utf-8'))
+        self.assertEqual([r[0] for r in results if r[1] is None], filenames[:2])
+    
+    def test_line_endings(self):
+        for filename, text in self.texts.items():
+            text=text.replace('\n', random.choice(['\r\n', '\r']))
+            file=open(filename, 'wb')
+            file.write(text.encode('utf-8'))
+            file.close()
+            self.texts[filename]=text
+        self.test_same_as_search_file()
+    
+    def test_limit(self):
+        results=list(search.search_files(sorted(self.texts), 'there', 2, 3, 'utf-8'))
+        self.assertEqual(len(results), min(3, sum(text.count('there') for text in self.texts.values())))
+
+class WordIndexTestCase(unittest.TestCase):
+    
+    def test_lookup(self):
+        rope=Rope('apple banana\ncherry\n', WordIndex())
+        rope.insert(len(rope), 'Banana split\n')
+        rope.insert(0, 'date\n' * 2000)
+        index=rope.index
+        
+        located=rope.locate(index.lookup(['banana']))
+        self.assertEqual( len(located), 1 )
+        offset, chunk=located[0]
+        self.assertEqual( rope[offset:offset+len(chunk)], chunk.text )
+        self.assert_( chunk.text.endswith('apple banana\ncherry\nBanana split\n') )
+        self.assertEqual( len(index.lookup(['nan', 'split'])), 1 )
+        self.assertEqual( index.lookup(['cherry', 'zebra']), set() )
+        self.assertEqual( index.lookup(['an', 'a']), None )
+        
+        rope.remove(0, len(rope))
+        self.assertEqual( len(index), 0 )
+        self.assertEqual( index._trigrams, {} )
+    
+    def test_substring_lookup(self):
+        index=WordIndex()
+        words=['word%d' % i for i in range(1000)]+['abcab', 'cabx']
+        rope=Rope(''.join('%s\n' % word for word in words), index)
+        self.assertEqual( sorted(index._words_containing('rd99')), ['word99', 'word990', 'word991', 'word992',
+                          'word993', 'word994', 'word995', 'word996', 'word997', 'word998', 'word999'] )
+        # has the trigrams of "bcabc" but not the whole thing
+        self.assertEqual( index._words_containing('bcabc'), [] )
+        self.assertEqual( sorted(index._words_containing('cab')), ['abcab', 'cabx'] )
+        # the same as checking every word
+        for term in ['ord', 'rd12', '999', 'word1000', 'zzz']:
+            self.assertEqual( sorted(index._words_containing(term)),
+                              sorted(word for word in index._postings if term in word) )
+
+class RopeTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        class SmallRope(Rope):
+            CHUNK_SIZE=8
+        self.rope=SmallRope()
+    
+    def test_insert_remove(self):
+        self.rope.insert(0,'hello there\nthis is a test')
+        self.assertEqual( self.rope[:], 'hello there\nthis is a test' )
+        self.rope.insert(5,'\nagain')
+        self.assertEqual( self.rope[:], 'hello\nagain there\nthis is a test' )
+        self.rope.remove(0,6)
+        self.assertEqual( self.rope[:], 'again there\nthis is a test' )
+        self.assertEqual( len(self.rope), len('again there\nthis is a test') )
+        self.assertEqual( self.rope[6:11], 'there' )
+        self.assertEqual( self.rope[-4:], 'test' )
+    
+    def test_chunks_hold_whole_lines(self):
+        for i in range(0,200):
+            self._random_edit()
+            chunks=list(self.rope.chunks())
+            for chunk in chunks[:-1]:
+                self.assert_( chunk.endswith('\n') )
+    
+    def test_line_starts(self):
+        self.rope.insert(0,'a\nbc\n\ndef\ng')
+        for offset, chunk in self.rope.iter_chunks():
+            text=chunk.text
+            expected=[0]+[i+1 for i, c in enumerate(text[:-1]) if c == '\n']
+            self.assertEqual( list(chunk.line_starts), expected )
+    
+    def test_random_edits(self):
+        text=''
+        for i in range(0,500):
+            text=self._random_edit(text)
+            self.assertEqual( self.rope[:], text )
+            self.assertEqual( len(self.rope), len(text) )
+            start=random.choice(range(len(text)+1))
+            end=random.choice(range(start,len(text)+1))
+            self.assertEqual( self.rope[start:end], text[start:end] )
+    
+    def test_mapped(self):
+        data=u'caf\xe9\r\nsome text\r\nand\rmore text\nhere\n'.encode('utf-8')*5
+        file=tempfile.TemporaryFile()
+        try:
+            file.write(data)
+            file.flush()
+            mapping=mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.rope=self.rope.mapped(MappedFile(mapping, 'utf-8'))
+            text=data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+            self.assertEqual( self.rope[:], text )
+            self.assertEqual( len(self.rope), len(text) )
+            for chunk in list(self.rope.chunks())[:-1]:
+                self.assert_( chunk.endswith('\n') )
+            for i in range(0,100):
+                text=self._random_edit(text)
+                self.assertEqual( self.rope[:], text )
+            mapping.close()
+        finally:
+            file.close()
+    
+    def test_changes(self):
+        self.rope.insert(0, ''.join('line %d\n' % i for i in range(100)))
+        for i in range(20):
+            other=self.rope.snapshot()
+            text=self.rope[:]
+            for j in range(random.choice(range(10))):
+                self._random_edit()
+            # applying the changes gets back to the other text
+            changed=self.rope[:]
+            for offset, length, inserted in self.rope.changes(other):
+                changed=changed[:offset]+inserted+changed[offset+length:]
+            self.assertEqual( changed, text )
+        self.assertEqual( self.rope.changes(self.rope.snapshot()), [] )
+    
+    def test_mapped_lengths(self):
+        class CountingFile(MappedFile):
+            decoded=0
+            def text(self, start, end):
+                self.decoded += 1
+                return MappedFile.text(self, start, end)
+        data=u'caf\xe9\r\nna\xefve\r\n\u2603 and\rmore\nhere\n'.encode('utf-8')*5
+        file=tempfile.TemporaryFile()
+        try:
+            file.write(data)
+            file.flush()
+            mapping=mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            for encoding in ['utf-8', 'latin-1', 'cp1252']:
+                mapped=CountingFile(mapping, encoding)
+                rope=self.rope.mapped(mapped)
+                if encoding != 'cp1252':
+                    # the lengths come from the bytes alone
+                    self.assertEqual( mapped.decoded, 0 )
+                text=data.decode(encoding).replace('\r\n', '\n').replace('\r', '\n')
+                self.assertEqual( len(rope), len(text) )
+                self.assertEqual( rope[:], text )
+            mapping.close()
+        finally:
+            file.close()
+    
+    def _random_edit(self, text=''):
+        length=len(self.rope)
+        offset=random.choice(range(length+1))
+        if length and random.random() < 0.4:
+            count=random.choice(range(1,min(length-offset,20)+1)) if offset < length else 0
+            self.rope.remove(offset, count)
+            return text[:offset]+text[offset+count:]
+        s=''.join(random.choice('ab \n') for i in range(random.choice(range(1,30))))
+        self.rope.insert(offset, s)
+        return text[:offset]+s+text[offset:]
+
 class UndoableDocumentTestCase(unittest.TestCase):
     
     def setUp(self):
@@ -247,6 +1397,198 @@ class UndoableDocumentTestCase(unittest.TestCase):
         self.assertEqual( self.doc.visible_text, self.doc.text )
         self.assertEqual( self.doc.text, '' )
     
+    def test_undo_redo_random_edits(self):
+        # keep every edit as its own undo
+        self.doc.COALESCE_TIMEOUT=0
+        self.doc.insert(0,'hello there\nthis is a test\nof search\nhello again\n\nhello')
+        states=[self._state()]
+        for i in range(150):
+            choice=random.random()
+            length=len(self.doc.visible_text)
+            offset=random.choice(range(length+1))
+            if choice < 0.2:
+                self.doc.search(random.choice(['', 'hello', 'e', 'o t', 'zzz']))
+            elif choice < 0.6 or not length:
+                self.doc.insert(offset, random.choice(['a', 'hello', 'x\ny', '\n']))
+            else:
+                offset=min(offset, length-1)
+                self.doc.remove(offset, min(random.choice(range(1, 6)), length-offset))
+            states.append(self._state())
+        
+        for state in reversed(states[:-1]):
+            self.doc.undo()
+            self.assertEqual( self._state(), state )
+        for state in states[1:]:
+            self.doc.redo()
+            self.assertEqual( self._state(), state )
+    
+    def test_undo_typing_a_word_at_a_time(self):
+        now=[0]
+        self.doc.clock=lambda: now[0]
+        self.doc.insert(0,'here is some text')
+        for c in ' and more':
+            now[0] += 0.1
+            self.doc.insert(len(self.doc.text), c)
+        for i in range(3):
+            now[0] += 0.1
+            self.doc.remove(len(self.doc.text)-1, 1)
+        self.assertEqual( self.doc.text, 'here is some text and m' )
+        
+        self.doc.undo() # undo backspacing
+        self.assertEqual( self.doc.text, 'here is some text and more' )
+        self.doc.undo()
+        self.assertEqual( self.doc.text, 'here is some text and ' )
+        self.doc.undo()
+        self.assertEqual( self.doc.text, 'here is some text ' )
+        self.doc.redo()
+        self.assertEqual( self.doc.text, 'here is some text and ' )
+        
+        # a pause starts a new undo, as does undoing
+        self.doc.insert(len(self.doc.text), 'x')
+        now[0] += 5
+        self.doc.insert(len(self.doc.text), 'y')
+        self.doc.undo()
+        self.assertEqual( self.doc.text, 'here is some text and x' )
+        self.doc.undo()
+        self.assertEqual( self.doc.text, 'here is some text and ' )
+    
+    def test_undo_limits(self):
+        self.doc.COALESCE_TIMEOUT=0
+        self.doc.MAX_UNDOS=5
+        for i in range(10):
+            self.doc.insert(0, str(i))
+        self.assertEqual( self.doc.undo_node.depth-self.doc.undo_root.depth, 5 )
+        
+        self.doc.MAX_UNDO_SIZE=1000
+        self.doc.insert(0, 'x'*2000)
+        self.assert_( self.doc.undo_node.parent is self.doc.undo_root )
+        self.doc.undo()
+        self.assertEqual( self.doc.text, '9876543210' )
+        self.assert_( not self.doc.can_undo() )
+    
+    def test_trimmed_root_checkpoint(self):
+        self.doc.COALESCE_TIMEOUT=0
+        self.doc.MAX_UNDOS=5
+        self.doc.CHECKPOINT_INTERVAL=4
+        texts=[]
+        for i in range(30):
+            self.doc.insert(0, '%d\n' % i)
+            texts.append(self.doc.text)
+            self.assert_( self.doc.undo_root.checkpoint is not None )
+        # further back than the checkpoint interval, so restores the root's
+        self.doc.jump_to(self.doc.undo_root)
+        self.assertEqual( self.doc.text, texts[-6] )
+        self.assert_( not self.doc.can_undo() )
+        self.doc.jump_to(self.doc.undo_root.children[0])
+        self.assertEqual( self.doc.text, texts[-5] )
+    
+    def test_coalesced_undo_size(self):
+        size=self.doc._undo_size
+        for i in range(100):
+            self.doc.insert(i, 'a')
+        self.assertEqual( self.doc.undo_node.parent, self.doc.undo_root )
+        # counted once for the one action, not once per key typed
+        self.assertEqual( self.doc._undo_size-size, self.doc.undo_node.action.size )
+    
+    def test_search_undo_size(self):
+        self.doc.insert(0, 'hello there\nthis is a test\n' * 100)
+        job=self.doc.search_job('hello', snapshot=True)
+        job.run()
+        self.doc.search('hello', job)
+        snapshot=weakref.ref(job._rope)
+        del job
+        gc.collect()
+        # the undo doesn't hold on to the job or the text it searched
+        self.assertEqual( snapshot(), None )
+        self.doc.undo()
+        self.assertEqual( self.doc.visible_text, self.doc.text )
+    
+    def test_undo_apply_edits(self):
+        self.doc.insert(0,'hello there\nthis is a test\nof search\nhello again')
+        self.doc.search('hello')
+        state=self._state()
+        self.doc.apply_edits([('remove', 3, 12), ('insert', 0, 'one '), ('insert', 23, ' two')])
+        self.assertEqual( self.doc.visible_text, 'one hello again two' )
+        edited=self._state()
+        self.doc.undo()
+        self.assertEqual( self._state(), state )
+        self.doc.redo()
+        self.assertEqual( self._state(), edited )
+    
+    def test_open_mapped(self):
+        dirname=tempfile.mkdtemp()
+        try:
+            filename=os.path.join(dirname, 'notes.txt')
+            file=open(filename, 'wb')
+            file.write(b'hello there\r\nthis is a test\n'*5)
+            file.close()
+            self.doc.insert(0, 'before\n')
+            self.doc.open(filename, mapped=True)
+            self.assertEqual( self.doc.text, 'hello there\nthis is a test\n'*5 )
+            self.assert_( not self.doc.can_undo() )
+            self.doc.insert(0, 'more\n')
+            self.doc.undo()
+            self.assertEqual( self.doc.text, 'hello there\nthis is a test\n'*5 )
+            self.doc.close()
+        finally:
+            shutil.rmtree(dirname)
+    
+    def test_undo_keeps_branches(self):
+        self.doc.insert(0,'hello there\n')
+        first=self.doc.undo_node
+        self.doc.insert(0,'one\n')
+        one=self.doc.undo_node
+        self.doc.undo()
+        self.doc.insert(0,'two\n')
+        self.assert_( not self.doc.can_redo() )
+        self.assertEqual( first.children, [one, self.doc.undo_node] )
+        
+        self.doc.jump_to(one)
+        self.assertEqual( self.doc.text, 'one\nhello there\n' )
+        self.doc.undo()
+        self.doc.redo() # back along the branch we came from
+        self.assertEqual( self.doc.text, 'one\nhello there\n' )
+        self.doc.jump_to(self.doc.undo_root)
+        self.assertEqual( self.doc.text, '' )
+    
+    def test_jump_to_checkpoint(self):
+        self.doc.COALESCE_TIMEOUT=0
+        self.doc.CHECKPOINT_INTERVAL=4
+        now=[0]
+        self.doc.clock=lambda: now[0]
+        self.doc.insert(0,'hello there\nthis is a test\nof search\nhello again\n')
+        states={}
+        nodes=[]
+        for i in range(40):
+            now[0] += 1
+            if i % 7 == 3:
+                self.doc.search(random.choice(['', 'hello', 'e', 'zzz']))
+            else:
+                length=len(self.doc.visible_text)
+                self.doc.insert(random.choice(range(length+1)), random.choice(['a', 'x\ny', '\n']))
+            nodes.append(self.doc.undo_node)
+            states[now[0]]=self._state()
+            # undo every so often to start a new branch
+            if i % 9 == 8:
+                self.doc.undo()
+                self.doc.undo()
+        
+        random.shuffle(nodes)
+        for node in nodes[:10]:
+            self.doc.jump_to(node)
+            self.assertEqual( self.doc.undo_node, node )
+            self.assertEqual( self._state(), states[node.time] )
+            self.doc.undo()
+            self.doc.redo()
+            self.assertEqual( self._state(), states[node.time] )
+        
+        self.doc.jump_to_time(11.5)
+        self.assertEqual( self._state(), states[11] )
+    
+    def _state(self):
+        sections=[(v.offset, v.length) for v in self.doc.visible_sections]
+        return self.doc.text, self.doc.visible_text, sections, self.doc.current_search, self.doc.current_offset
+    
     def test_undo_redo(self):
         self.doc.insert(0,'hello today\nhere is some text\nhello there')
         self.assertEqual( self.doc.visible_text, 'hello today\nhere is some text\nhello there')
@@ -0,0 +1,106 @@
+'''
+an inverted index from the words in a rope's chunks to the chunks
+that contain them, used to narrow down which chunks need searching.
+
+words are split on whitespace, the same as search terms, so any search
+term found in a line has to be a substring of one of the line's words.
+to find those words without checking every one, there's a second index
+from each three letter piece of a word (trigram) to the words with it in.
+a word containing a term has all of the term's trigrams.
+'''
+
+def _trigrams(text):
+    return set(text[i:i+3] for i in range(len(text)-2))
+
+class WordIndex(object):
+    # search terms shorter than this match too many words to be
+    # worth looking up, so don't narrow the search down at all
+    MIN_TERM_LENGTH=3
+
+    def __init__(self):
+        self._postings={}
+        # trigram -> words containing it
+        self._trigrams={}
+
+    def __len__(self):
+        return len(self._postings)
+
+    def update(self, removed, added):
+        '''update the index as chunks are removed and added to the rope'''
+        postings=self._postings
+        for chunk in removed:
+            for word in self._words(chunk):
+                chunks=postings[word]
+                chunks.discard(chunk)
+                if not chunks:
+                    del postings[word]
+                    self._remove_word(word)
+        for chunk in added:
+            for word in self._words(chunk):
+                chunks=postings.get(word)
+                if chunks is None:
+                    chunks=postings[word]=set()
+                    self._add_word(word)
+                chunks.add(chunk)
+
+    def _add_word(self, word):
+        trigrams=self._trigrams
+        for trigram in _trigrams(word):
+            words=trigrams.get(trigram)
+            if words is None:
+                words=trigrams[trigram]=set()
+            words.add(word)
+
+    def _remove_word(self, word):
+        trigrams=self._trigrams
+        for trigram in _trigrams(word):
+            words=trigrams[trigram]
+            words.discard(word)
+            if not words:
+                del trigrams[trigram]
+
+    def lookup(self, search_words):
+        '''
+        the set of chunks that could contain all of the (lower case)
+        search words, or None if the index can't narrow things down
+        '''
+        candidates=[self._candidates(term) for term in set(search_words)
+                        if len(term) >= self.MIN_TERM_LENGTH]
+        if not candidates:
+            return None
+        # start with the rarest term, so the intersection stays small
+        candidates.sort(key=len)
+        chunks=set(candidates[0])
+        for other in candidates[1:]:
+            if not chunks:
+                break
+            chunks.intersection_update(other)
+        return chunks
+
+    def _words_containing(self, term):
+        '''the words in the index that term is a substring of'''
+        word_sets=[]
+        for trigram in _trigrams(term):
+            words=self._trigrams.get(trigram)
+            if not words:
+                return []
+            word_sets.append(words)
+        word_sets.sort(key=len)
+        words=word_sets[0]
+        if len(word_sets) > 1:
+            words=words.intersection(*word_sets[1:])
+        # having all the trigrams doesn't mean they're in the right order
+        return [word for word in words if term in word]
+
+    def _candidates(self, term):
+        postings=self._postings
+        matches=[postings[word] for word in self._words_containing(term)]
+        if len(matches) == 1:
+            return matches[0]
+        chunks=set()
+        for other in matches:
+            chunks.update(other)
+        return chunks
+
+    def _words(self, chunk):
+        return set(chunk.text.lower().split())
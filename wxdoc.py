@@ -1,15 +1,14 @@
 import wx
 
+import socket
 import sys
 import tempfile
 import webbrowser
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 
-from events import Event
-from pipe import Pipe
+from background import SaveScheduler
+from pipe import Pipe, pipe_name
+import preferences
+from refresh import Refresher
 
 PREF_WINDOW_STATE='WINDOW_STATE'
 
@@ -25,28 +24,30 @@ class Singleton(object):
             Singleton._instances[cls] = instance
         return instance
 
-class Preferences(Singleton):
+class ConfigStore(object):
+    '''a store for preferences.Preferences using the app's wx.ConfigBase'''
     
-    def __init__(self):
-        if 'cfg' not in vars(self):
-            self.cfg=wx.ConfigBase.Get()
-            self.changed=Event()
-    
-    def get(self, key, defaultValue):
-        value=self.cfg.Read(key, '')
-        try:
-            return pickle.loads(str(value))
-        except:
-            return defaultValue
+    def __init__(self, cfg):
+        self.cfg=cfg
     
-    def set(self, key, value):
-        result=self.cfg.Write(key, pickle.dumps(value))
-        self.changed(key, value)
-        return result
+    def read(self, key):
+        if not self.cfg.HasEntry(key):
+            return None
+        return self.cfg.Read(key, '')
     
-    def flush(self):
+    def write(self, items):
+        for key, value in items:
+            self.cfg.Write(key, value)
         self.cfg.Flush()
 
+class Preferences(Singleton, preferences.Preferences):
+    
+    def __init__(self):
+        if 'store' not in vars(self):
+            # changes are passed on in batches, once the app is idle
+            preferences.Preferences.__init__(self, ConfigStore(wx.ConfigBase.Get()),
+                                             post=wx.CallAfter)
+
 def check_for_modification(fn):
     def _decorated(self,event):
         if self.doc.is_modified:
@@ -101,6 +102,7 @@ class DocumentFrame(wx.Frame):
 
         self.file_save=self.AddMenuItem(self.file_menu, "Save\tCtrl-S", self.OnSave, -1)
         self.AddMenuItem(self.file_menu, "Save As...\tShift-Ctrl-S", self.OnSaveAs, -1)
+        self.file_revert=self.AddMenuItem(self.file_menu, "Revert to Saved", self.OnRevert, -1)
         self.file_menu.AppendSeparator()
 
         self.AddMenuItem(self.file_menu, "Preferences...\tCtrl-K", self.OnPreferences, wx.ID_PREFERENCES)
@@ -138,7 +140,14 @@ class DocumentFrame(wx.Frame):
 
         self.prefs=Preferences()
 
-        self.UpdateMenus()
+        # the title and menus are only brought up to date when the app is
+        # idle, and then only if what they show has changed
+        self.refresher=Refresher(post=self._post_refresh)
+        self.refresher.add('title', lambda: (self.doc.filename, self.doc.is_modified),
+                           self._update_title)
+        self.refresher.add('menus', lambda: (self.doc.is_saved, self.doc.can_undo(), self.doc.can_redo(),
+                                             bool(self.doc.filename) and self.doc.is_modified),
+                           self._update_menus)
         self.update_recent_files_menu()
         
         self.SetWindowsIcon()
@@ -184,7 +193,6 @@ class DocumentFrame(wx.Frame):
         state = self.IsMaximized()
         
         self.prefs.set(PREF_WINDOW_STATE,(state,x,y,width,height))
-        self.prefs.flush()
     
     def GetDocFilename(self):
         return self.doc.filename
@@ -201,13 +209,25 @@ class DocumentFrame(wx.Frame):
         self.UpdateMenus()
 
     def UpdateMenus(self):
-        title=self.doc.filename or '<untitled>'
-        if self.doc.is_modified:
+        self.refresher.invalidate()
+    
+    def _post_refresh(self, refresh):
+        # the frame may have been closed by the time it's idle
+        wx.CallAfter(lambda: self and refresh())
+    
+    def _update_title(self, inputs):
+        filename, is_modified=inputs
+        title=filename or '<untitled>'
+        if is_modified:
             title += '*'
         self.SetTitle(title)
-        self.file_save.Enable(not self.doc.is_saved)
-        self.edit_undo.Enable(self.doc.can_undo())
-        self.edit_redo.Enable(self.doc.can_redo())
+    
+    def _update_menus(self, inputs):
+        is_saved, can_undo, can_redo, can_revert=inputs
+        self.file_save.Enable(not is_saved)
+        self.file_revert.Enable(can_revert)
+        self.edit_undo.Enable(can_undo)
+        self.edit_redo.Enable(can_redo)
 
     def OnNew(self,event):
         wx.GetApp().OpenFile(None)
@@ -248,6 +268,15 @@ class DocumentFrame(wx.Frame):
             self._update_recent_files(filename)
             self.UpdateMenus()
 
+    def OnRevert(self,event):
+        dialog=wx.MessageDialog(self,"Your changes will be lost.","Do you want to revert to the saved file?",wx.YES_NO | wx.ICON_QUESTION)
+        dialog.CenterOnParent()
+        result=dialog.ShowModal()
+        dialog.Destroy()
+        if result == wx.ID_YES:
+            self.doc.revert()
+            self.UpdateFromDoc()
+
     def OnPreferences(self,event):
         wx.GetApp().ShowPreferences()
     
@@ -273,10 +302,9 @@ class DocumentFrame(wx.Frame):
         wx.GetApp().OpenFile(file)
 
     def _update_recent_files(self, file_name):
-        recent_files=self.prefs.get('recent_files',[])
-        if file_name in recent_files:
-            recent_files.remove(file_name)
-        recent_files.insert(0, file_name)
+        # a new list, as the one from prefs is shared
+        recent_files=[file_name]+[file for file in self.prefs.get('recent_files',[])
+                                  if file != file_name]
         if len(recent_files) > 8:
             recent_files=recent_files[:8]
         self.prefs.set('recent_files', recent_files)
@@ -290,6 +318,7 @@ class DocumentFrame(wx.Frame):
     @check_for_modification
     def OnClose(self, event):
         self.SaveDefaultSizeAndPosition()
+        self.doc.close()
         self.Destroy()
 
     def OnDestroyed(self, event):
@@ -321,9 +350,15 @@ class DocApp(wx.App):
     def OnInit(self):
         self.SetAppName(self.__APP_NAME__)
         
-        self._pipe=Pipe(self.GetAppName() + '-' + wx.GetUserId())
+        self._pipe=Pipe(pipe_name(self.GetAppName()))
         
         self._frames=[]
+        
+        # one scheduler for all the frames, so their auto-saves are spread out
+        self.save_scheduler=SaveScheduler(post=wx.CallAfter)
+        self.save_timer=wx.Timer(self,-1)
+        self.Bind(wx.EVT_TIMER, self.OnSaveTimer, self.save_timer)
+        self.save_timer.Start(5*1000)
 
         files=sys.argv[1:]
         self.OpenFiles(files)
@@ -334,8 +369,18 @@ class DocApp(wx.App):
         return True
     
     def OnExit(self):
+        self.save_timer.Stop()
+        # let any auto-saves that have started finish writing
+        self.save_scheduler.flush()
+        Preferences().flush()
+        self._pipe.close()
         del self._singleInstanceChecker
     
+    def OnSaveTimer(self, event):
+        self.save_scheduler.poll()
+        # write any preferences that have changed since last time
+        Preferences().flush()
+    
     def ShowPreferences(self):
         if not self.prefs_dialog.IsShown():
             self.prefs_dialog.Show()
@@ -343,7 +388,11 @@ class DocApp(wx.App):
     def OpenFiles(self, files):
         self._singleInstanceChecker = wx.SingleInstanceChecker(self.GetAppName() + '-' + wx.GetUserId(), tempfile.gettempdir())
         if self._singleInstanceChecker.IsAnotherRunning():
-            self._pipe.write(files)
+            try:
+                self._pipe.write(files)
+            except socket.error:
+                wx.MessageBox("%s is already running, but isn't responding." % self.GetAppName(),
+                              self.GetAppName(), wx.OK | wx.ICON_ERROR)
         else:
             if not files:
                 files=[None]
@@ -351,12 +400,10 @@ class DocApp(wx.App):
             for filename in files:
                 self.OpenFile(filename)
             
-            self.timer=wx.Timer(self,-1)
-            self.Bind(wx.EVT_TIMER, self.CheckForOpenFiles, self.timer)
-            self.timer.Start(1000)
+            # files opened from elsewhere arrive on another thread
+            self._pipe.listen(self.FilesReceived, wx.CallAfter)
     
-    def CheckForOpenFiles(self, event):
-        files=self._pipe.read()
+    def FilesReceived(self, files):
         if files:
             for filename in files:
                 self.OpenFile(filename)